@@ -1,15 +1,226 @@
+import bisect
+import hashlib
+import math
 import os
-import shutil
 import sqlite3
-import webbrowser
+import threading
+import time
+from collections import OrderedDict
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QSplitter,
                                QPushButton, QLabel, QGraphicsView, QGraphicsScene, QGraphicsPixmapItem,
-                               QStatusBar, QListWidget, QListWidgetItem, QLineEdit, QFileDialog, QCheckBox)
+                               QGraphicsItem,
+                               QStatusBar, QListWidget, QListWidgetItem, QLineEdit, QFileDialog, QCheckBox,
+                               QComboBox, QProgressBar, QMessageBox, QListView, QStyledItemDelegate, QStyle,
+                               QSpinBox)
 from PySide6.QtGui import (QPixmap, QImage, QWheelEvent, QPainter, QColor, QPen, QKeyEvent, 
-                          QFont, QBrush, QPainterPath, QFontMetrics, QCursor)
-from PySide6.QtCore import Qt, QRectF, QPointF, QEvent, QSizeF, QSettings
+                          QFont, QBrush, QPainterPath, QFontMetrics, QCursor, QImageReader, QImageIOHandler,
+                          QTransform, QDesktopServices)
+from PySide6.QtCore import (Qt, QRect, QRectF, QPointF, QEvent, QSizeF, QSize, QSettings, QObject, QRunnable,
+                            QThreadPool, QThread, QTimer, Signal, QAbstractListModel, QModelIndex,
+                            QStandardPaths, QItemSelectionModel, QFileSystemWatcher, QUrl)
+from image_label_core import (DUPLICATE_RADIUS, LEGACY_DB_NAME, PROFILER, DuplicateIndex, FileIndex, QueryCursor, TagDatabase,
+                              scan_folder, organize_dataset, delete_files, rename_images, run_rename_batch, register_folder,
+                              index_perceptual_hashes, identify_files, diff_directories, open_dataset,
+                              read_exif_thumbnail)
+
+APP_STYLESHEET = """
+    QPushButton[role="primary"] {
+        font-size: 14px;
+        padding: 8px;
+        background-color: #4CAF50;
+        color: white;
+        border-radius: 5px;
+        border: none;
+    }
+    QPushButton[role="primary"]:hover {
+        background-color: #45a049;
+    }
+    QPushButton[role="tool"] {
+        font-size: 14px;
+        padding: 8px;
+    }
+    QLineEdit[role="input"] {
+        font-size: 14px;
+        padding: 8px;
+        border-radius: 5px;
+        border: 1px solid #ccc;
+    }
+    QListWidget#tagList {
+        font-size: 16px;
+        font-weight: bold;
+        font-family: "Microsoft YaHei";
+        background-color: #dbfaff;
+        border-radius: 5px;
+        padding: 5px;
+        color: #ff7a30;
+    }
+    QListWidget#tagList::item {
+        padding: 6px;
+        color: #FF0000;
+        background-color: #FFBC4C;
+        border-bottom: 1px solid #fff;
+    }
+    QListWidget#tagList::item:checked {
+        color: #FF0000; /* 选中项字体颜色 */
+    }
+"""
+
+ORGANIZE_MODE_LABELS = {
+    'copy': "复制",
+    'hardlink': "硬链接",
+    'reflink': "Reflink (写时复制)",
+    'symlink': "符号链接",
+}
+
+TILE_SIZE = 512
+TILE_SOURCE_BYTES = 64 * 1024 * 1024
+
+class TileSignals(QObject):
+    loaded = Signal(object, QImage)
+
+class TileSource:
+    def __init__(self, max_bytes=TILE_SOURCE_BYTES):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.wanted = None
+        self.key = None
+        self.image = QImage()
+
+    def set_path(self, path):
+        with self.lock:
+            self.wanted = path
+            if self.key is not None and self.key[0] != path:
+                self.key = None
+                self.image = QImage()
+
+    def image_for(self, path, level, size):
+        with self.lock:
+            if path != self.wanted:
+                return QImage()
+            while level < 16 and (size.width() >> level) * (size.height() >> level) * 4 > self.max_bytes:
+                level += 1
+            if self.key != (path, level):
+                self.key = None
+                self.image = QImage()
+                reader = QImageReader(path)
+                if level:
+                    reader.setScaledSize(QSize(max(1, size.width() >> level), max(1, size.height() >> level)))
+                with PROFILER.span("decode"):
+                    self.image = reader.read()
+                self.key = (path, level)
+            return self.image
+
+class TileTask(QRunnable):
+    def __init__(self, key, source_rect, scaled_size, signals, source):
+        super().__init__()
+        self.key = key
+        self.source_rect = source_rect
+        self.scaled_size = scaled_size
+        self.signals = signals
+        self.source = source
+
+    def run(self):
+        reader = QImageReader(self.key[0])
+        if reader.supportsOption(QImageIOHandler.ClipRect):
+            reader.setClipRect(self.source_rect)
+            if reader.supportsOption(QImageIOHandler.ScaledSize):
+                reader.setScaledSize(self.scaled_size)
+            image = reader.read()
+        else:
+            size = reader.size()
+            image = self.source.image_for(self.key[0], self.key[1], size)
+            if not image.isNull():
+                sx, sy = image.width() / size.width(), image.height() / size.height()
+                rect = self.source_rect
+                image = image.copy(QRect(int(rect.x() * sx), int(rect.y() * sy),
+                                         max(1, math.ceil(rect.width() * sx)), max(1, math.ceil(rect.height() * sy))))
+        if not image.isNull() and image.size() != self.scaled_size:
+            image = image.scaled(self.scaled_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        self.signals.loaded.emit(self.key, image)
+
+class TileLoader(QObject):
+    def __init__(self, max_bytes=128 * 1024 * 1024, parent=None):
+        super().__init__(parent)
+        self.cache = ImageCache(max_bytes)
+        self.pending = set()
+        self.item = None
+        self.source = TileSource()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(2, QThread.idealThreadCount() // 2))
+        self.signals = TileSignals()
+        self.signals.loaded.connect(self._on_loaded)
+
+    def set_item(self, item):
+        self.pool.clear()
+        self.pending.clear()
+        self.item = item
+        self.source.set_path(item and item.path)
+
+    def tile(self, key, source_rect, scaled_size):
+        pixmap = self.cache.get(key)
+        if pixmap is None and key not in self.pending:
+            self.pending.add(key)
+            self.pool.start(TileTask(key, source_rect, scaled_size, self.signals, self.source))
+        return pixmap
+
+    def _on_loaded(self, key, image):
+        self.pending.discard(key)
+        if image.isNull():
+            return
+        self.cache.put(key, QPixmap.fromImage(image))
+        if self.item is not None and self.item.path == key[0]:
+            self.item.update(self.item.tile_rect(*key[1:]))
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+
+class TiledImageItem(QGraphicsItem):
+    def __init__(self, path, source_size, loader):
+        super().__init__()
+        self.path = path
+        self.source_size = source_size
+        self.loader = loader
+        self.max_level = max(0, math.ceil(math.log2(max(source_size.width(), source_size.height()) / TILE_SIZE)))
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.source_size.width(), self.source_size.height())
+
+    def tile_rect(self, level, column, row):
+        span = TILE_SIZE << level
+        return QRect(column * span, row * span,
+                     min(span, self.source_size.width() - column * span),
+                     min(span, self.source_size.height() - row * span))
+
+    def level_for(self, lod):
+        if lod >= 1:
+            return 0
+        return min(self.max_level, int(math.floor(math.log2(1 / lod))))
+
+    def paint(self, painter, option, widget=None):
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+        if widget is not None:
+            lod *= widget.devicePixelRatioF()
+        level = self.level_for(lod)
+        span = TILE_SIZE << level
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+        for row in range(int(exposed.top()) // span, int(math.ceil(exposed.bottom())) // span + 1):
+            for column in range(int(exposed.left()) // span, int(math.ceil(exposed.right())) // span + 1):
+                rect = self.tile_rect(level, column, row)
+                if rect.width() <= 0 or rect.height() <= 0:
+                    continue
+                scaled_size = QSize(max(1, math.ceil(rect.width() / (1 << level))),
+                                    max(1, math.ceil(rect.height() / (1 << level))))
+                pixmap = self.loader.tile((self.path, level, column, row), rect, scaled_size)
+                if pixmap is not None:
+                    painter.drawPixmap(QRectF(rect), pixmap, QRectF(pixmap.rect()))
 
 class ImageViewer(QGraphicsView):
+    zoom_changed = Signal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setRenderHint(QPainter.Antialiasing)
@@ -20,42 +231,82 @@ class ImageViewer(QGraphicsView):
         self.scene = QGraphicsScene(self)
         self.setScene(self.scene)
         self.pixmap_item = None
+        self.tile_item = None
+        self.tile_loader = TileLoader(parent=self)
+        self.preview_scale = 1.0
         self.current_scale = 1.0
+        self.fitted = True
         self.max_scale = 5.0 
         self.min_scale = 0.1  
+    
+    def decode_size(self):
+        return (self.viewport().size() * self.devicePixelRatioF()).expandedTo(QSize(1024, 1024))
         
-    def set_image(self, pixmap):
+    def set_image(self, pixmap, path=None, source_size=None, tileable=False, keep_view=False):
+        keep_view = keep_view and not self.fitted and self.pixmap_item is not None
+        if keep_view:
+            transform = self.transform()
+            center = self.mapToScene(self.viewport().rect().center())
         if self.pixmap_item:
             self.scene.removeItem(self.pixmap_item)
             self.pixmap_item = None
+        if self.tile_item:
+            self.scene.removeItem(self.tile_item)
+            self.tile_item = None
+        self.tile_loader.set_item(None)
 
         if not pixmap.isNull():
             self.pixmap_item = QGraphicsPixmapItem(pixmap)
+            self.pixmap_item.setTransformationMode(Qt.SmoothTransformation)
             self.scene.addItem(self.pixmap_item)
             self.pixmap_item.setZValue(0)
             
-            self.reset_zoom()
+            self.preview_scale = 1.0
+            if source_size is not None and source_size.width() > pixmap.width():
+                self.preview_scale = pixmap.width() / source_size.width()
+                self.pixmap_item.setScale(1 / self.preview_scale)
+                if tileable and path:
+                    self.tile_item = TiledImageItem(path, source_size, self.tile_loader)
+                    self.tile_item.setZValue(1)
+                    self.tile_item.setVisible(False)
+                    self.scene.addItem(self.tile_item)
+                    self.tile_loader.set_item(self.tile_item)
+            self.scene.setSceneRect(self.pixmap_item.sceneBoundingRect())
+            
+            if keep_view:
+                self.setTransform(transform)
+                self.centerOn(center)
+                self.update_tiles()
+            else:
+                self.reset_zoom()
         
     def reset_zoom(self):
         if self.pixmap_item:
             self.fitInView(self.pixmap_item, Qt.KeepAspectRatio)
             self.current_scale = self.transform().m11()
+            self.fitted = True
+            self.update_tiles()
+    
+    def zoom(self, zoom_factor):
+        new_scale = self.current_scale * zoom_factor
+        if new_scale <= self.max_scale if zoom_factor > 1 else new_scale >= self.min_scale:
+            self.scale(zoom_factor, zoom_factor)
+            self.current_scale = new_scale
+            self.fitted = False
+            self.update_tiles()
+            self.zoom_changed.emit()
+    
+    def update_tiles(self):
+        if self.tile_item:
+            self.tile_item.setVisible(
+                self.current_scale * self.devicePixelRatioF() > self.preview_scale * 1.05)
         
     def wheelEvent(self, event: QWheelEvent):
         zoom_factor = 1.15
         if event.angleDelta().y() > 0:
-            new_scale = self.current_scale * zoom_factor
-            if new_scale <= self.max_scale:
-                self.scale(zoom_factor, zoom_factor)
-                self.current_scale = new_scale
+            self.zoom(zoom_factor)
         else:
-            new_scale = self.current_scale / zoom_factor
-            if new_scale >= self.min_scale:
-                self.scale(1 / zoom_factor, 1 / zoom_factor)
-                self.current_scale = new_scale
-                
-        if self.parent() and hasattr(self.parent(), 'update_zoom_status'):
-            self.parent().update_zoom_status()
+            self.zoom(1 / zoom_factor)
                 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
@@ -81,26 +332,655 @@ class ImageViewer(QGraphicsView):
             self.setCursor(Qt.ArrowCursor)
         super().mouseReleaseEvent(event)
 
+class ImageCache:
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    @staticmethod
+    def pixmap_bytes(entry):
+        pixmap = getattr(entry, 'pixmap', entry)
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def __contains__(self, path):
+        return path in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, path):
+        pixmap = self._items.get(path)
+        if pixmap is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(path)
+        self.hits += 1
+        return pixmap
+
+    def peek(self, path):
+        return self._items.get(path)
+
+    def put(self, path, pixmap):
+        size = self.pixmap_bytes(pixmap)
+        if size > self.max_bytes:
+            return
+        self.discard(path)
+        self._items[path] = pixmap
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self._items:
+            _, evicted = self._items.popitem(last=False)
+            self.current_bytes -= self.pixmap_bytes(evicted)
+
+    def discard(self, path):
+        pixmap = self._items.pop(path, None)
+        if pixmap is not None:
+            self.current_bytes -= self.pixmap_bytes(pixmap)
+
+    def clear(self):
+        self._items.clear()
+        self.current_bytes = 0
+
+class DecodedImage:
+    __slots__ = ('pixmap', 'source_size', 'tileable')
+
+    def __init__(self, pixmap, source_size, tileable):
+        self.pixmap = pixmap
+        self.source_size = source_size
+        self.tileable = tileable
+
+class ImageLoadSignals(QObject):
+    loaded = Signal(str, QImage, QSize, bool)
+
+class ImageLoadTask(QRunnable):
+    def __init__(self, path, target_size, signals, started):
+        super().__init__()
+        self.path = path
+        self.target_size = target_size
+        self.signals = signals
+        self.started = started
+
+    def run(self):
+        self.started.add(self.path)
+        reader = QImageReader(self.path)
+        reader.setAutoTransform(True)
+        source_size = reader.size()
+        tileable = reader.transformation() == QImageIOHandler.TransformationNone
+        if tileable and source_size.isValid() and not self.target_size.isEmpty() and (
+                source_size.width() > self.target_size.width() or
+                source_size.height() > self.target_size.height()):
+            reader.setScaledSize(source_size.scaled(self.target_size, Qt.KeepAspectRatio))
+        with PROFILER.span("decode"):
+            image = reader.read()
+        if not tileable or not source_size.isValid():
+            source_size = image.size()
+        self.signals.loaded.emit(self.path, image, source_size, tileable)
+
+def apply_transformation(image, transformation):
+    horizontal = bool(transformation & QImageIOHandler.TransformationMirror)
+    vertical = bool(transformation & QImageIOHandler.TransformationFlip)
+    if horizontal or vertical:
+        image = image.mirrored(horizontal, vertical)
+    if transformation & QImageIOHandler.TransformationRotate90:
+        image = image.transformed(QTransform().rotate(90))
+    return image
+
+class PreviewSignals(QObject):
+    loaded = Signal(str, QImage, QSize)
+
+class PreviewTask(QRunnable):
+    def __init__(self, path, size, signals, started):
+        super().__init__()
+        self.path = path
+        self.size = size
+        self.signals = signals
+        self.started = started
+
+    def run(self):
+        self.started.add(self.path)
+        reader = QImageReader(self.path)
+        reader.setAutoTransform(True)
+        source_size = reader.size()
+        transformation = reader.transformation()
+        if source_size.isValid() and transformation & QImageIOHandler.TransformationRotate90:
+            source_size = source_size.transposed()
+        with PROFILER.span("preview"):
+            image = QImage()
+            if source_size.isValid() and bytes(reader.format()) == b'jpeg':
+                thumbnail = read_exif_thumbnail(self.path)
+                if thumbnail:
+                    image = apply_transformation(QImage.fromData(thumbnail), transformation)
+                    expected = source_size.scaled(image.size(), Qt.KeepAspectRatio)
+                    if (abs(expected.width() - image.width()) > 1 or abs(expected.height() - image.height()) > 1):
+                        image = QImage()
+            if image.isNull():
+                if source_size.isValid() and max(source_size.width(), source_size.height()) > self.size:
+                    scaled = reader.size().scaled(self.size, self.size, Qt.KeepAspectRatio)
+                    reader.setScaledSize(scaled.expandedTo(QSize(1, 1)))
+                image = reader.read()
+        if not source_size.isValid():
+            source_size = image.size()
+        self.signals.loaded.emit(self.path, image, source_size)
+
+class ImagePrefetcher(QObject):
+    image_ready = Signal(str)
+    preview_ready = Signal(str)
+
+    def __init__(self, cache, radius=3, preview_size=480, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.previews = ImageCache(64 * 1024 * 1024)
+        self.radius = radius
+        self.preview_size = preview_size
+        self.target_size = QSize()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(2, QThread.idealThreadCount() // 2))
+        self.pending = set()
+        self.started = set()
+        self.preview_pending = set()
+        self.preview_started = set()
+        self.signals = ImageLoadSignals()
+        self.signals.loaded.connect(self._on_loaded)
+        self.preview_signals = PreviewSignals()
+        self.preview_signals.loaded.connect(self._on_preview_loaded)
+
+    def request(self, path, priority=0):
+        if path in self.pending or path in self.cache:
+            return
+        self.pending.add(path)
+        self.pool.start(ImageLoadTask(path, self.target_size, self.signals, self.started), priority)
+
+    def request_preview(self, path, priority=0):
+        if path in self.preview_pending or path in self.previews or path in self.cache:
+            return
+        self.preview_pending.add(path)
+        self.pool.start(PreviewTask(path, self.preview_size, self.preview_signals, self.preview_started), priority)
+
+    def prefetch(self, files, index, previews_only=False):
+        self.pool.clear()
+        self.pending &= self.started
+        self.preview_pending &= self.preview_started
+        if not 0 <= index < len(files):
+            return
+        request = self.request_preview if previews_only else self.request
+        self.request_preview(files[index], self.radius + 2)
+        if not previews_only:
+            self.request(files[index], self.radius + 1)
+        for offset in range(1, self.radius + 1):
+            for i in (index + offset, index - offset):
+                if 0 <= i < len(files):
+                    request(files[i], self.radius - offset)
+
+    def _on_loaded(self, path, image, source_size, tileable):
+        self.pending.discard(path)
+        self.started.discard(path)
+        if not image.isNull():
+            with PROFILER.span("upload"):
+                pixmap = QPixmap.fromImage(image)
+            self.cache.put(path, DecodedImage(pixmap, source_size, tileable))
+        self.image_ready.emit(path)
+
+    def _on_preview_loaded(self, path, image, source_size):
+        self.preview_pending.discard(path)
+        self.preview_started.discard(path)
+        if not image.isNull():
+            self.previews.put(path, DecodedImage(QPixmap.fromImage(image), source_size, False))
+        self.preview_ready.emit(path)
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+
+THUMBNAIL_SIZE = 128
+
+PROFILE_LABELS = {
+    'show': "切换", 'time_to_preview': "预览", 'time_to_image': "出图", 'preview': "预览解码", 'decode': "解码", 'upload': "上传", 'set_image': "显示",
+    'select_tags': "查询标签", 'tag_list': "标签列表", 'add_tag': "添加标签", 'remove_tag': "删除标签",
+    'bulk_tag': "批量标签", 'flush': "写库",
+}
+
+class ThumbnailDiskCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def key_for(path, stat):
+        return hashlib.sha1(f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}".encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], key + ".jpg")
+
+    def load(self, key):
+        image = QImage(self.path_for(key))
+        return None if image.isNull() else image
+
+    def store(self, key, image):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        if image.save(tmp_path, "JPG", 85):
+            os.replace(tmp_path, path)
+
+class ThumbnailSignals(QObject):
+    loaded = Signal(str, int, QImage)
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, path, row, disk_cache, signals):
+        super().__init__()
+        self.path = path
+        self.row = row
+        self.disk_cache = disk_cache
+        self.signals = signals
+
+    def run(self):
+        try:
+            key = self.disk_cache.key_for(self.path, os.stat(self.path))
+        except OSError:
+            self.signals.loaded.emit(self.path, self.row, QImage())
+            return
+        image = self.disk_cache.load(key)
+        if image is None:
+            reader = QImageReader(self.path)
+            reader.setAutoTransform(True)
+            size = reader.size()
+            if size.isValid():
+                reader.setScaledSize(size.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio))
+            image = reader.read()
+            if not image.isNull():
+                if max(image.width(), image.height()) > THUMBNAIL_SIZE:
+                    image = image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio,
+                                         Qt.SmoothTransformation)
+                try:
+                    self.disk_cache.store(key, image)
+                except OSError:
+                    pass
+        self.signals.loaded.emit(self.path, self.row, image)
+
+class ThumbnailModel(QAbstractListModel):
+    TaggedRole = Qt.UserRole + 1
+
+    def __init__(self, app, disk_cache, parent=None):
+        super().__init__(parent)
+        self.app = app
+        self.disk_cache = disk_cache
+        self.pixmaps = ImageCache(64 * 1024 * 1024)
+        self.tagged = {}
+        self.pending = set()
+        self.request_count = 0
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(2, QThread.idealThreadCount() // 2))
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self._on_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.app.image_files)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.app.image_files):
+            return None
+        path = self.app.image_files[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.ToolTipRole:
+            return path
+        if role == Qt.DecorationRole:
+            pixmap = self.pixmaps.get(path)
+            if pixmap is None and path not in self.pending:
+                self.pending.add(path)
+                self.request_count += 1
+                self.pool.start(ThumbnailTask(path, index.row(), self.disk_cache, self.signals),
+                                self.request_count)
+            return pixmap
+        if role == self.TaggedRole:
+            tagged = self.tagged.get(path)
+            if tagged is None:
+                tagged = self.tagged[path] = bool(self.app.db.get_tags(path))
+            return tagged
+        return None
+
+    def _on_loaded(self, path, row, image):
+        self.pending.discard(path)
+        if image.isNull():
+            return
+        self.pixmaps.put(path, QPixmap.fromImage(image))
+        if row < len(self.app.image_files) and self.app.image_files[row] == path:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def append_rows(self, paths):
+        first = len(self.app.image_files)
+        self.beginInsertRows(QModelIndex(), first, first + len(paths) - 1)
+        self.app.image_files.extend(paths)
+        self.endInsertRows()
+
+    def reset(self, files=()):
+        self.beginResetModel()
+        self.app.image_files = FileIndex(files)
+        self.tagged.clear()
+        self.endResetModel()
+
+    def remove_paths(self, paths):
+        self.beginResetModel()
+        rows = self.app.image_files.remove(paths)
+        self.tagged.clear()
+        self.endResetModel()
+        return rows
+
+    def refresh_all(self):
+        self.tagged.clear()
+        if self.app.image_files:
+            self.dataChanged.emit(self.index(0), self.index(len(self.app.image_files) - 1))
+
+    def refresh_row(self, row):
+        if 0 <= row < len(self.app.image_files):
+            self.tagged.pop(self.app.image_files[row], None)
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [self.TaggedRole])
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+
+class ThumbnailDelegate(QStyledItemDelegate):
+    def sizeHint(self, option, index):
+        return QSize(THUMBNAIL_SIZE + 12, THUMBNAIL_SIZE + 30)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        rect = option.rect.adjusted(6, 4, -6, -4)
+        
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is not None and not pixmap.isNull():
+            size = pixmap.size().scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio)
+            x = rect.left() + (rect.width() - size.width()) // 2
+            y = rect.top() + (THUMBNAIL_SIZE - size.height()) // 2
+            painter.drawPixmap(x, y, size.width(), size.height(), pixmap)
+        
+        tagged = index.data(ThumbnailModel.TaggedRole)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(QColor("#4CAF50" if tagged else "#999999"), 2))
+        painter.setBrush(QColor("#4CAF50") if tagged else Qt.NoBrush)
+        painter.drawEllipse(QRectF(rect.right() - 14, rect.top() + 2, 12, 12))
+        
+        painter.setPen(option.palette.highlightedText().color() if option.state & QStyle.State_Selected
+                       else option.palette.text().color())
+        name = painter.fontMetrics().elidedText(index.data(Qt.DisplayRole), Qt.ElideMiddle, rect.width())
+        painter.drawText(rect.left(), rect.top() + THUMBNAIL_SIZE, rect.width(), rect.bottom() - rect.top() - THUMBNAIL_SIZE,
+                         Qt.AlignCenter, name)
+        painter.restore()
+
+class FolderScanner(QThread):
+    batch_found = Signal(list)
+
+    def __init__(self, folder, recursive=False, db=None, batch_size=1000, batch_interval=0.1, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.recursive = recursive
+        self.db = db
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.added = []
+        self.changed = []
+        self.stale = []
+
+    def run(self):
+        snapshot, exclude = {}, set()
+        if self.db is not None:
+            db = self.db.reopen()
+            try:
+                snapshot = db.scan_snapshot(self.folder, self.recursive)
+                exclude = db.organize_directories()
+            finally:
+                db.close()
+        batch = []
+        last_emit = 0.0
+        for directory, mtime_ns, files, subdirectories, added, changed in scan_folder(self.folder, self.recursive,
+                                                                                        snapshot, exclude):
+            if self.isInterruptionRequested():
+                return
+            snapshot.pop(directory, None)
+            if changed:
+                self.changed.append((directory, mtime_ns, files, subdirectories))
+                self.added.extend(os.path.join(directory, name) for name in added)
+            for start in range(0, len(files), self.batch_size):
+                batch.extend(os.path.join(directory, name) for name in files[start:start + self.batch_size])
+                now = time.monotonic()
+                if len(batch) >= self.batch_size or now - last_emit >= self.batch_interval:
+                    self.batch_found.emit(batch)
+                    batch = []
+                    last_emit = now
+        if batch:
+            self.batch_found.emit(batch)
+        self.stale = list(snapshot)
+
+class ReconcileWorker(QThread):
+    completed = Signal(object)
+
+    def __init__(self, db, folder, paths, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.folder = folder
+        self.paths = paths
+
+    def run(self):
+        db = self.db.reopen()
+        try:
+            known = db.file_identities(self.folder)
+        finally:
+            db.close()
+        identities = identify_files(self.paths, known, cancelled=self.isInterruptionRequested)
+        if not self.isInterruptionRequested():
+            self.completed.emit(identities)
+
+class FolderSyncWorker(QThread):
+    completed = Signal(object, object, object, object)
+
+    def __init__(self, db, directories, known, recursive, watched, exclude=(), parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.directories = directories
+        self.known = known
+        self.recursive = recursive
+        self.watched = watched
+        self.exclude = exclude
+
+    def run(self):
+        added, removed, new_directories = diff_directories(self.directories, self.known, self.recursive,
+                                                           self.watched, self.exclude)
+        identities = []
+        if added and not self.isInterruptionRequested():
+            db = self.db.reopen()
+            try:
+                known = db.identities_for(added)
+            finally:
+                db.close()
+            identities = identify_files(added, known, cancelled=self.isInterruptionRequested)
+        if not self.isInterruptionRequested():
+            self.completed.emit(added, removed, new_directories, identities)
+
+class JobSignals(QObject):
+    progress = Signal(int, int)
+    finished = Signal(object, object)
+
+class Job(QRunnable):
+    def __init__(self, name, label, func, db=None, reads=(), writes=()):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.name = name
+        self.label = label
+        self.func = func
+        self.db = db
+        self.reads = set(reads)
+        self.writes = set(writes)
+        self.on_finished = None
+        self.result = None
+        self.signals = JobSignals()
+        self.cancel_requested = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def conflicts(self, other):
+        return bool(self.writes & (other.reads | other.writes) or other.writes & self.reads)
+
+    def cancelled(self):
+        self.resumed.wait()
+        return self.cancel_requested.is_set()
+
+    def cancel(self):
+        self.cancel_requested.set()
+        self.resumed.set()
+
+    def progress(self, done, total):
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        if self.cancelled():
+            self.signals.finished.emit(None, None)
+            return
+        db = self.db.reopen() if self.db is not None else None
+        result = error = None
+        try:
+            result = self.func(self, db)
+        except Exception as e:
+            error = e
+        finally:
+            if db is not None:
+                db.close()
+        self.result = result
+        self.signals.finished.emit(result, error)
+
+class JobScheduler(QObject):
+    progress = Signal(int, int)
+    changed = Signal()
+
+    def __init__(self, max_jobs=2, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_jobs)
+        self.running = []
+        self.queued = []
+        self.paused = False
+
+    def has(self, name):
+        return any(job.name == name for job in self.running + self.queued)
+
+    def busy(self):
+        return bool(self.running or self.queued)
+
+    def submit(self, job, on_finished):
+        job.on_finished = on_finished
+        job.signals.progress.connect(self.progress)
+        job.signals.finished.connect(self.on_job_finished)
+        self.queued.append(job)
+        self.start_ready_jobs()
+        self.changed.emit()
+
+    def start_ready_jobs(self):
+        waiting = []
+        for job in list(self.queued):
+            if any(job.conflicts(other) for other in self.running + waiting):
+                waiting.append(job)
+                continue
+            self.queued.remove(job)
+            self.running.append(job)
+            if self.paused and not job.cancel_requested.is_set():
+                job.resumed.clear()
+            self.pool.start(job)
+
+    def on_job_finished(self, result, error):
+        job = next((job for job in self.running if job.signals is self.sender()), None)
+        if job is None:
+            return
+        self.running.remove(job)
+        job.on_finished(result, error, job.cancel_requested.is_set())
+        self.start_ready_jobs()
+        if not self.busy():
+            self.paused = False
+        self.changed.emit()
+
+    def set_paused(self, paused):
+        self.paused = paused
+        for job in self.running:
+            if paused and not job.cancel_requested.is_set():
+                job.resumed.clear()
+            else:
+                job.resumed.set()
+        self.changed.emit()
+
+    def cancel_all(self):
+        for job in self.running + self.queued:
+            job.cancel()
+
+    def shutdown(self):
+        self.queued = []
+        self.cancel_all()
+        self.pool.waitForDone()
+        finished, self.running = self.running, []
+        return finished
+
 class ImageTaggingApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Image Label Management System")
         self.setGeometry(100, 100, 1200, 800)
         
-        self.db_conn = sqlite3.connect('image_tags.db')
-        self.create_database()
+        self.settings = QSettings("Ka5fxt", "ImageTaggingApp")
+        self.db = TagDatabase(':memory:', self.settings.value("db_cache_mb", 64, type=int))
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(self.settings.value("db_flush_interval_ms", 2000, type=int))
+        self.flush_timer.timeout.connect(self.flush_tag_changes)
         
         self.image_folder = ""
-        self.image_files = []
+        self.image_files = FileIndex()
         self.current_index = -1
         self.current_image_name = "" 
-        self.batch_size = 100
-        self.loaded_count = 0
+        self.scanner = None
+        self.scan_recursive = False
+        self.resume_path = None
+        self.resume_index = 0
+        self.reconcile_worker = None
+        self.sync_worker = None
+        self.changed_directories = set()
+        self.scheduler = JobScheduler(self.settings.value("max_jobs", 2, type=int), self)
+        self.duplicate_index = None
+        self.query_cursor = None
         self.operation_status = ""  
         
-        self.settings = QSettings("Ka5fxt", "ImageTaggingApp")
         self.default_tag = self.settings.value("default_tag", "默认标签", type=str)
         
+        cache_mb = self.settings.value("image_cache_mb", 512, type=int)
+        self.image_cache = ImageCache(cache_mb * 1024 * 1024)
+        
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(self.settings.value("watch_debounce_ms", 500, type=int))
+        self.sync_timer.timeout.connect(self.sync_folder)
+        self.prefetcher = ImagePrefetcher(
+            self.image_cache, self.settings.value("prefetch_radius", 3, type=int),
+            self.settings.value("preview_size", 480, type=int), self)
+        self.prefetcher.image_ready.connect(self.on_image_ready)
+        self.prefetcher.preview_ready.connect(self.on_preview_ready)
+        self.pending_image_path = ""
+        self.displayed_path = ""
+        self.displayed_preview = False
+        self.show_started = 0.0
+        self.skimming = False
+        self.show_timer = QTimer(self)
+        self.show_timer.setSingleShot(True)
+        self.show_timer.setInterval(0)
+        self.show_timer.timeout.connect(self.show_current_image)
+        self.full_decode_timer = QTimer(self)
+        self.full_decode_timer.setSingleShot(True)
+        self.full_decode_timer.setInterval(self.settings.value("full_decode_delay_ms", 150, type=int))
+        self.full_decode_timer.timeout.connect(self.stop_skimming)
+        
         main_widget = QWidget()
         main_layout = QHBoxLayout(main_widget)
         
@@ -111,108 +991,62 @@ class ImageTaggingApp(QMainWindow):
         left_layout.setContentsMargins(10, 10, 10, 10)
         
         self.btn_open = QPushButton("打开图片文件夹")
-        self.btn_open.setStyleSheet("""
-            QPushButton {
-                font-size: 14px;
-                padding: 8px;
-                background-color: #4CAF50;
-                color: white;
-                border-radius: 5px;
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
+        self.btn_open.setProperty("role", "primary")
         self.btn_open.clicked.connect(self.open_image_folder)
         left_layout.addWidget(self.btn_open)
         
-        self.btn_load_more = QPushButton("继续加载 (100张)")
-        self.btn_load_more.setStyleSheet("""
-            QPushButton {
-                font-size: 14px;
-                padding: 8px;
-                background-color: #4CAF50;
-                color: white;
-                border-radius: 5px;
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
-        self.btn_load_more.clicked.connect(self.load_more_images)
-        self.btn_load_more.setEnabled(False)
-        left_layout.addWidget(self.btn_load_more)
+        self.recursive_check = QCheckBox("包含子文件夹")
+        self.recursive_check.setChecked(self.settings.value("recursive_scan", False, type=bool))
+        self.recursive_check.toggled.connect(
+            lambda checked: self.settings.setValue("recursive_scan", checked))
+        left_layout.addWidget(self.recursive_check)
         
         left_layout.addWidget(QLabel("重命名操作"))
         self.rename_prefix = QLineEdit()
-        self.rename_prefix.setStyleSheet("""
-            QLineEdit {
-                font-size: 14px;
-                padding: 8px;
-                border-radius: 5px;
-                border: 1px solid #ccc;
-            }
-        """)
+        self.rename_prefix.setProperty("role", "input")
         self.rename_prefix.setPlaceholderText("输入文件名前缀")
         left_layout.addWidget(self.rename_prefix)
         
         self.btn_rename = QPushButton("批量重命名")
-        self.btn_rename.setStyleSheet("""
-            QPushButton {
-                font-size: 14px;
-                padding: 8px;
-                background-color: #4CAF50;
-                color: white;
-                border-radius: 5px;
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
+        self.btn_rename.setProperty("role", "primary")
         self.btn_rename.clicked.connect(self.batch_rename)
         self.btn_rename.setEnabled(False)
         left_layout.addWidget(self.btn_rename)
         
         left_layout.addWidget(QLabel("整理操作"))
         self.btn_organize = QPushButton("整理已标记图片")
-        self.btn_organize.setStyleSheet("""
-            QPushButton {
-                font-size: 14px;
-                padding: 8px;
-                background-color: #4CAF50;
-                color: white;
-                border-radius: 5px;
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
+        self.btn_organize.setProperty("role", "primary")
         self.btn_organize.clicked.connect(self.organize_images)
         self.btn_organize.setEnabled(False)
+        
+        self.organize_mode = QComboBox()
+        for mode, label in ORGANIZE_MODE_LABELS.items():
+            self.organize_mode.addItem(label, mode)
+        self.organize_mode.setCurrentIndex(
+            max(0, self.organize_mode.findData(self.settings.value("organize_mode", "copy", type=str))))
+        self.organize_mode.currentIndexChanged.connect(
+            lambda: self.settings.setValue("organize_mode", self.organize_mode.currentData()))
+        left_layout.addWidget(self.organize_mode)
+        
+        self.skip_duplicates_check = QCheckBox("跳过相似图片")
+        self.skip_duplicates_check.setChecked(self.settings.value("organize_skip_duplicates", False, type=bool))
+        self.skip_duplicates_check.toggled.connect(
+            lambda checked: self.settings.setValue("organize_skip_duplicates", checked))
+        left_layout.addWidget(self.skip_duplicates_check)
         left_layout.addWidget(self.btn_organize)
         
         self.btn_delete = QPushButton("删除未标记图片")
-        self.btn_delete.setStyleSheet("""
-            QPushButton {
-                font-size: 14px;
-                padding: 8px;
-                background-color: #4CAF50;
-                color: white;
-                border-radius: 5px;
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
+        self.btn_delete.setProperty("role", "primary")
         self.btn_delete.clicked.connect(self.delete_unlabeled)
         self.btn_delete.setEnabled(False)
         left_layout.addWidget(self.btn_delete)
         
+        self.btn_index_hashes = QPushButton("建立相似图片索引")
+        self.btn_index_hashes.setProperty("role", "primary")
+        self.btn_index_hashes.clicked.connect(self.index_hashes)
+        self.btn_index_hashes.setEnabled(False)
+        left_layout.addWidget(self.btn_index_hashes)
+        
         left_layout.addSpacing(20)
         left_layout.addWidget(QLabel("键盘快捷键:"))
         left_layout.addWidget(QLabel("A - 上一张图片"))
@@ -224,47 +1058,55 @@ class ImageTaggingApp(QMainWindow):
         left_layout.addStretch()
         
         self.image_viewer = ImageViewer(self)
+        self.image_viewer.zoom_changed.connect(self.update_zoom_status)
+        
+        thumbnail_dir = os.path.join(
+            QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "thumbnails")
+        self.thumbnail_model = ThumbnailModel(self, ThumbnailDiskCache(thumbnail_dir), self)
+        self.thumbnail_view = QListView()
+        self.thumbnail_view.setModel(self.thumbnail_model)
+        self.thumbnail_view.setItemDelegate(ThumbnailDelegate(self.thumbnail_view))
+        self.thumbnail_view.setFlow(QListView.LeftToRight)
+        self.thumbnail_view.setWrapping(False)
+        self.thumbnail_view.setUniformItemSizes(True)
+        self.thumbnail_view.setLayoutMode(QListView.Batched)
+        self.thumbnail_view.setBatchSize(500)
+        self.thumbnail_view.setHorizontalScrollMode(QListView.ScrollPerPixel)
+        self.thumbnail_view.setFocusPolicy(Qt.NoFocus)
+        self.thumbnail_view.setSelectionMode(QListView.ExtendedSelection)
+        self.thumbnail_view.setFixedHeight(THUMBNAIL_SIZE + 50)
+        self.thumbnail_view.clicked.connect(self.on_thumbnail_clicked)
+        
+        viewer_splitter = QSplitter(Qt.Vertical)
+        viewer_splitter.addWidget(self.image_viewer)
+        viewer_splitter.addWidget(self.thumbnail_view)
+        viewer_splitter.setStretchFactor(0, 1)
         
         right_panel = QWidget()
         right_layout = QVBoxLayout(right_panel)
         right_layout.setContentsMargins(10, 10, 10, 10)
         
         self.tag_list = QListWidget()
-        self.tag_list.setStyleSheet("""
-            QListWidget {
-                font-size: 16px;
-                font-weight: bold;
-                font-family: "Microsoft YaHei";
-                background-color: #dbfaff;
-                border-radius: 5px;
-                padding: 5px;
-                color: #ff7a30;
-            }
-            QListWidget::item {
-                padding: 6px;
-                color: #FF0000;
-                background-color: #FFBC4C;
-                border-bottom: 1px solid #fff;
-            }
-            QListWidget::item:checked {
-                color: #FF0000; /* 选中项字体颜色 */
-            }
-        """)
+        self.tag_list.setObjectName("tagList")
         self.tag_list.itemClicked.connect(self.remove_tag)
+        
+        self.filter_input = QLineEdit()
+        self.filter_input.setProperty("role", "input")
+        self.filter_input.setPlaceholderText("筛选: defect AND NOT reviewed")
+        self.filter_input.setToolTip("支持 AND / OR / NOT、括号、tag* 前缀匹配、untagged / tagged，回车应用，清空后回车取消筛选")
+        self.filter_input.returnPressed.connect(self.apply_filter)
+        self.filter_label = QLabel("未筛选")
+        right_layout.addWidget(QLabel("筛选:"))
+        right_layout.addWidget(self.filter_input)
+        right_layout.addWidget(self.filter_label)
+        
         right_layout.addWidget(QLabel("当前标签:"))
         right_layout.addWidget(self.tag_list)
         
         default_tag_layout = QHBoxLayout()
         default_tag_layout.addWidget(QLabel("默认标签:"))
         self.default_tag_input = QLineEdit(self.default_tag)
-        self.default_tag_input.setStyleSheet("""
-            QLineEdit {
-                font-size: 14px;
-                padding: 8px;
-                border-radius: 5px;
-                border: 1px solid #ccc;
-            }
-        """)
+        self.default_tag_input.setProperty("role", "input")
         self.default_tag_input.textChanged.connect(self.update_default_tag)
         default_tag_layout.addWidget(self.default_tag_input)
         
@@ -276,61 +1118,88 @@ class ImageTaggingApp(QMainWindow):
         right_layout.addLayout(default_tag_layout)
         
         self.new_tag_input = QLineEdit()
-        self.new_tag_input.setStyleSheet("""
-            QLineEdit {
-                font-size: 14px;
-                padding: 8px;
-                border-radius: 5px;
-                border: 1px solid #ccc;
-            }
-        """)
+        self.new_tag_input.setProperty("role", "input")
         self.new_tag_input.setPlaceholderText("输入新标签")
         self.new_tag_input.returnPressed.connect(self.add_tag)
         right_layout.addWidget(QLabel("输入新标签:"))
         right_layout.addWidget(self.new_tag_input)
         
         self.btn_add_tag = QPushButton("添加标签")
-        self.btn_add_tag.setStyleSheet("""
-            QPushButton {
-                font-size: 14px;
-                padding: 8px;
-                background-color: #4CAF50;
-                color: white;
-                border-radius: 5px;
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
+        self.btn_add_tag.setProperty("role", "primary")
         self.btn_add_tag.clicked.connect(self.add_tag)
         right_layout.addWidget(self.btn_add_tag)
         
+        bulk_scope_layout = QHBoxLayout()
+        self.bulk_scope = QComboBox()
+        self.bulk_scope.addItem("选中的缩略图", "selection")
+        self.bulk_scope.addItem("当前图片前后", "range")
+        self.bulk_scope.addItem("全部筛选结果", "query")
+        bulk_scope_layout.addWidget(self.bulk_scope)
+        self.bulk_radius = QSpinBox()
+        self.bulk_radius.setRange(0, 1000000)
+        self.bulk_radius.setSuffix(" 张")
+        self.bulk_radius.setValue(self.settings.value("bulk_radius", 10, type=int))
+        self.bulk_radius.valueChanged.connect(lambda value: self.settings.setValue("bulk_radius", value))
+        bulk_scope_layout.addWidget(self.bulk_radius)
+        right_layout.addWidget(QLabel("批量标签:"))
+        right_layout.addLayout(bulk_scope_layout)
+        
+        bulk_layout = QHBoxLayout()
+        self.btn_bulk_add = QPushButton("批量添加")
+        self.btn_bulk_add.setProperty("role", "tool")
+        self.btn_bulk_add.clicked.connect(lambda: self.bulk_tag(True))
+        bulk_layout.addWidget(self.btn_bulk_add)
+        
+        self.btn_bulk_remove = QPushButton("批量移除")
+        self.btn_bulk_remove.setProperty("role", "tool")
+        self.btn_bulk_remove.clicked.connect(lambda: self.bulk_tag(False))
+        bulk_layout.addWidget(self.btn_bulk_remove)
+        right_layout.addLayout(bulk_layout)
+        
+        self.duplicate_radius = self.settings.value("duplicate_radius", DUPLICATE_RADIUS, type=int)
+        self.duplicate_list = QListWidget()
+        self.duplicate_list.setMaximumHeight(120)
+        self.duplicate_list.itemClicked.connect(self.on_duplicate_clicked)
+        right_layout.addWidget(QLabel("相似图片:"))
+        right_layout.addWidget(self.duplicate_list)
+        
+        duplicate_layout = QHBoxLayout()
+        self.btn_find_duplicates = QPushButton("查找相似图片")
+        self.btn_find_duplicates.setProperty("role", "tool")
+        self.btn_find_duplicates.clicked.connect(self.find_duplicates)
+        duplicate_layout.addWidget(self.btn_find_duplicates)
+        
+        self.btn_propagate_tags = QPushButton("同步标签到相似图片")
+        self.btn_propagate_tags.setProperty("role", "tool")
+        self.btn_propagate_tags.clicked.connect(self.propagate_tags)
+        duplicate_layout.addWidget(self.btn_propagate_tags)
+        right_layout.addLayout(duplicate_layout)
+        
         nav_layout = QHBoxLayout()
         self.btn_prev = QPushButton("上一张 (A)")
-        self.btn_prev.setStyleSheet("font-size: 14px; padding: 8px;")
+        self.btn_prev.setProperty("role", "tool")
         self.btn_prev.clicked.connect(self.show_prev_image)
         nav_layout.addWidget(self.btn_prev)
         
         self.btn_next = QPushButton("下一张 (D)")
-        self.btn_next.setStyleSheet("font-size: 14px; padding: 8px;")
+        self.btn_next.setProperty("role", "tool")
         self.btn_next.clicked.connect(self.show_next_image)
         nav_layout.addWidget(self.btn_next)
         right_layout.addLayout(nav_layout)
         
         zoom_layout = QHBoxLayout()
         self.btn_zoom_in = QPushButton("放大 (+)")
-        self.btn_zoom_in.setStyleSheet("font-size: 14px; padding: 8px;")
+        self.btn_zoom_in.setProperty("role", "tool")
         self.btn_zoom_in.clicked.connect(self.zoom_in)
         zoom_layout.addWidget(self.btn_zoom_in)
         
         self.btn_zoom_out = QPushButton("缩小 (-)")
-        self.btn_zoom_out.setStyleSheet("font-size: 14px; padding: 8px;")
+        self.btn_zoom_out.setProperty("role", "tool")
         self.btn_zoom_out.clicked.connect(self.zoom_out)
         zoom_layout.addWidget(self.btn_zoom_out)
         
         self.btn_reset_zoom = QPushButton("重置缩放 (R)")
-        self.btn_reset_zoom.setStyleSheet("font-size: 14px; padding: 8px;")
+        self.btn_reset_zoom.setProperty("role", "tool")
         self.btn_reset_zoom.clicked.connect(self.reset_zoom)
         zoom_layout.addWidget(self.btn_reset_zoom)
         
@@ -339,7 +1208,7 @@ class ImageTaggingApp(QMainWindow):
         right_layout.addStretch()
         
         splitter.addWidget(left_panel)
-        splitter.addWidget(self.image_viewer)
+        splitter.addWidget(viewer_splitter)
         splitter.addWidget(right_panel)
         splitter.setSizes([200, 600, 200])
         
@@ -355,9 +1224,38 @@ class ImageTaggingApp(QMainWindow):
         self.zoom_label = QLabel("缩放: 100%")
         self.status_bar.addWidget(self.zoom_label)
         
+        self.profile_label = QLabel()
+        self.profile_label.setToolTip("最近一次 / p95 耗时 (ms)，F12 开关，Shift+F12 保存性能记录")
+        self.profile_label.hide()
+        self.status_bar.addWidget(self.profile_label)
+        self.profile_timer = QTimer(self)
+        self.profile_timer.setInterval(500)
+        self.profile_timer.timeout.connect(self.update_profile_status)
+        
+        self.cache_label = QLabel()
+        self.status_bar.addWidget(self.cache_label)
+        
         self.operation_label = QLabel()
         self.status_bar.addPermanentWidget(self.operation_label)
         
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.status_bar.addPermanentWidget(self.progress_bar)
+        
+        self.btn_pause = QPushButton("暂停")
+        self.btn_pause.clicked.connect(self.toggle_pause)
+        self.btn_pause.hide()
+        self.status_bar.addPermanentWidget(self.btn_pause)
+        
+        self.btn_cancel = QPushButton("取消")
+        self.btn_cancel.clicked.connect(self.scheduler.cancel_all)
+        self.btn_cancel.hide()
+        self.status_bar.addPermanentWidget(self.btn_cancel)
+        
+        self.scheduler.progress.connect(self.on_operation_progress)
+        self.scheduler.changed.connect(self.update_job_status)
+        
         self.github_link = QLabel("<a href='https://github.com/ka5fxt' style='color: #1E90FF; text-decoration: none;'>ka5fxt : github.com/ka5fxt</a>")
         self.github_link.setOpenExternalLinks(False)  
         self.github_link.linkActivated.connect(self.open_github)
@@ -365,8 +1263,12 @@ class ImageTaggingApp(QMainWindow):
         self.status_bar.addPermanentWidget(self.github_link)
         
         self.toggle_default_tag()
+        self.set_profiling(self.settings.value("profiling_enabled", False, type=bool))
         
+        left_panel.setStyleSheet(APP_STYLESHEET)
+        right_panel.setStyleSheet(APP_STYLESHEET)
         self.installEventFilter(self)
+        QTimer.singleShot(0, self.resume_last_folder)
         
     def update_default_tag(self):
         self.default_tag = self.default_tag_input.text()
@@ -382,15 +1284,17 @@ class ImageTaggingApp(QMainWindow):
             self.new_tag_input.clear()
     
     def open_github(self, link):
-        webbrowser.open(link)
+        QDesktopServices.openUrl(QUrl(link))
         
     def eventFilter(self, obj, event):
         if event.type() == QEvent.KeyPress:
             key = event.key()
             if key == Qt.Key_A:
+                self.skimming = event.isAutoRepeat()
                 self.show_prev_image()
                 return True
             elif key == Qt.Key_D:
+                self.skimming = event.isAutoRepeat()
                 self.show_next_image()
                 return True
             elif key == Qt.Key_Plus or key == Qt.Key_Equal:
@@ -402,99 +1306,371 @@ class ImageTaggingApp(QMainWindow):
             elif key == Qt.Key_R:
                 self.reset_zoom()
                 return True
+            elif key == Qt.Key_F12:
+                if event.modifiers() & Qt.ShiftModifier:
+                    self.save_profile()
+                else:
+                    self.set_profiling(not PROFILER.enabled)
+                return True
+        elif (event.type() == QEvent.KeyRelease and not event.isAutoRepeat()
+              and event.key() in (Qt.Key_A, Qt.Key_D)):
+            self.stop_skimming()
+            return True
         return super().eventFilter(obj, event)
         
     def update_zoom_status(self):
         self.zoom_label.setText(f"缩放: {self.image_viewer.current_scale*100:.0f}%")
-        
-    def create_database(self):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                path TEXT UNIQUE,
-                tags TEXT
-            )
-        ''')
-        self.db_conn.commit()
+    
+    def set_profiling(self, enabled):
+        PROFILER.enabled = enabled
+        self.settings.setValue("profiling_enabled", enabled)
+        self.profile_label.setVisible(enabled)
+        if enabled:
+            self.profile_timer.start()
+            self.update_profile_status()
+        else:
+            self.profile_timer.stop()
+            PROFILER.clear()
+    
+    def update_profile_status(self):
+        summary = PROFILER.summary()
+        parts = [f"{label} {summary[name][0] * 1000:.1f}/{summary[name][1] * 1000:.1f}"
+                 for name, label in PROFILE_LABELS.items() if name in summary]
+        self.profile_label.setText(" | ".join(parts) if parts else "性能统计: 暂无数据")
+    
+    def save_profile(self):
+        if not PROFILER.events:
+            self.set_operation_status("暂无性能记录，请先按 F12 开启性能统计")
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "保存性能记录", "profile.json",
+                                              "Chrome Trace (*.json);;JSON Lines (*.jsonl)")
+        if path:
+            count = PROFILER.dump(path)
+            self.set_operation_status(f"已保存 {count} 条性能记录到 {path}")
         
     def open_image_folder(self):
+        if self.scheduler.busy():
+            self.set_operation_status("请等待当前操作完成或取消后再打开文件夹")
+            return
         folder = QFileDialog.getExistingDirectory(self, "选择图片文件夹")
         if folder:
-            self.image_folder = folder
-            self.image_files = [
-                os.path.join(folder, f) for f in os.listdir(folder) 
-                if os.path.isfile(os.path.join(folder, f)) and 
-                f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))
-            ]
-            self.loaded_count = 0
-            self.current_index = -1
-            self.btn_load_more.setEnabled(len(self.image_files) > 0)
+            self.resume_path = None
+            self.load_folder(folder)
+    
+    def resume_last_folder(self):
+        folder = self.settings.value("last_folder", "", type=str)
+        if (self.image_folder or not folder or not os.path.isdir(folder)
+                or not self.settings.value("resume_last_folder", True, type=bool)):
+            return
+        self.resume_path = self.settings.value("last_image", "", type=str) or None
+        self.resume_index = self.settings.value("last_index", 0, type=int)
+        self.load_folder(folder)
+    
+    def save_position(self):
+        if not self.image_folder:
+            return
+        self.settings.setValue("last_folder", self.image_folder)
+        if 0 <= self.current_index < len(self.image_files):
+            self.settings.setValue("last_index", self.current_index)
+            self.settings.setValue("last_image", self.image_files[self.current_index])
+    
+    def load_folder(self, folder):
+        self.stop_scanner()
+        self.flush_tag_changes()
+        self.db.close()
+        self.db = open_dataset(folder, self.db.cache_mb, legacy_db=LEGACY_DB_NAME)
+        self.duplicate_index = None
+        self.recover_renames()
+        self.db.load_tags()
+        self.image_folder = folder
+        self.settings.setValue("last_folder", folder)
+        self.settings.remove("last_image")
+        self.settings.remove("last_index")
+        self.scan_recursive = self.recursive_check.isChecked()
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        self.watcher.addPath(folder)
+        self.changed_directories.clear()
+        if self.query_cursor is not None:
+            self.apply_filter()
+        self.thumbnail_model.reset()
+        self.current_index = -1
+        self.set_operation_status("正在扫描图片...")
+        
+        self.scanner = FolderScanner(folder, self.scan_recursive, self.db, parent=self)
+        self.scanner.batch_found.connect(self.on_scan_batch)
+        self.scanner.finished.connect(self.on_scan_finished)
+        self.scanner.start()
+    
+    def on_scan_batch(self, paths):
+        if self.sender() is not self.scanner:
+            return
+        self.thumbnail_model.append_rows(paths)
+        self.set_operation_status(f"正在扫描图片... 已找到: {len(self.image_files)} 张")
+        self.show_first_image()
+        self.update_status()
+    
+    def on_scan_finished(self):
+        scanner = self.sender()
+        if scanner is not self.scanner:
+            return
+        self.scanner = None
+        self.set_operation_status(f"找到图片: {len(self.image_files)} 张")
+        if self.scan_recursive:
+            directories = {os.path.dirname(prefix) for prefix in self.image_files.directories} - {self.image_folder}
+            if directories:
+                self.watcher.addPaths(sorted(directories))
+        self.show_first_image()
+        if not scanner.changed and not scanner.stale:
+            self.update_status()
+            return
+        paths, changed, stale = scanner.added, scanner.changed, scanner.stale
+        
+        def run(job, db):
+            registered = register_folder(db, paths, job.cancelled, job.progress)
+            if not job.cancelled():
+                db.save_scan_snapshot(changed, stale)
+            return registered
+        self.start_job(Job('register', "正在登记图片", run, self.db, writes={'files'}),
+                       lambda result, error, cancelled: self.on_register_completed(paths, error, cancelled))
+    
+    def on_register_completed(self, paths, error, cancelled):
+        if error is not None:
+            self.set_operation_status(f"登记图片失败: {error}")
+        elif cancelled:
+            self.set_operation_status("登记图片已取消")
+        else:
             self.set_operation_status(f"找到图片: {len(self.image_files)} 张")
-            self.load_more_images()
-            
-    def load_more_images(self):
-        if not self.image_files:
+        self.flush_tag_changes()
+        if not paths:
+            return
+        self.reconcile_worker = ReconcileWorker(self.db, self.image_folder, paths, self)
+        self.reconcile_worker.completed.connect(self.on_reconcile_completed)
+        self.reconcile_worker.start()
+    
+    def on_reconcile_completed(self, identities):
+        if self.sender() is not self.reconcile_worker:
+            return
+        self.reconcile_worker.wait()
+        self.reconcile_worker = None
+        if not identities:
             return
-            
-        end_index = min(self.loaded_count + self.batch_size, len(self.image_files))
-        batch_files = self.image_files[self.loaded_count:end_index]
         
-        cursor = self.db_conn.cursor()
-        for file_path in batch_files:
-            try:
-                cursor.execute(
-                    "INSERT OR IGNORE INTO images (path, tags) VALUES (?, ?)",
-                    (file_path, "")
-                )
-            except sqlite3.IntegrityError:
-                pass  
-        
-        self.db_conn.commit()
-        self.loaded_count = end_index
-        
-        if self.current_index == -1 and batch_files:
-            self.current_index = self.loaded_count - len(batch_files)
-            self.show_current_image()
-            
+        def run(job, db):
+            moved = db.reconcile(identities)
+            db.commit()
+            return moved
+        self.start_job(Job('reconcile', "正在识别移动过的图片", run, self.db, reads={'files'}),
+                       self.on_moves_reconciled)
+    
+    def on_moves_reconciled(self, moved, error, cancelled):
+        if error is not None:
+            self.set_operation_status(f"识别移动过的图片失败: {error}")
+        if moved:
+            self.db.rename_pending(dict(moved))
+        self.flush_tag_changes()
+        if moved:
+            self.duplicate_index = None
+            self.thumbnail_model.refresh_all()
+            self.refresh_tag_list()
+            self.update_filter_count()
+            self.set_operation_status(f"找到图片: {len(self.image_files)} 张，已按内容识别 {len(moved)} 张移动过的图片并保留其标签")
+    
+    def is_scanning(self):
+        return self.scanner is not None and self.scanner.isRunning()
+    
+    def stop_scanner(self):
+        if self.scanner is not None:
+            self.scanner.requestInterruption()
+            self.scanner.wait()
+            self.scanner = None
+        for worker in (self.reconcile_worker, self.sync_worker):
+            if worker is not None:
+                worker.requestInterruption()
+                worker.wait()
+        self.reconcile_worker = None
+        self.sync_worker = None
+    
+    def on_directory_changed(self, directory):
+        self.changed_directories.add(directory)
+        if not self.sync_timer.isActive():
+            self.sync_timer.start()
+    
+    def sync_folder(self):
+        if not self.changed_directories:
+            return
+        if (self.is_scanning() or self.reconcile_worker is not None or self.sync_worker is not None
+                or self.tags_locked()):
+            self.sync_timer.start()
+            return
+        directories = list(self.changed_directories)
+        self.changed_directories.clear()
+        self.sync_worker = FolderSyncWorker(self.db, directories, self.image_files.copy(), self.scan_recursive,
+                                            set(self.watcher.directories()), self.db.organize_directories(), self)
+        self.sync_worker.completed.connect(self.on_sync_completed)
+        self.sync_worker.start()
+    
+    def on_sync_completed(self, added, removed, new_directories, identities):
+        if self.sender() is not self.sync_worker:
+            return
+        self.sync_worker.wait()
+        self.sync_worker = None
+        if new_directories:
+            self.watcher.addPaths(new_directories)
+        if self.changed_directories:
+            self.sync_timer.start()
+        if not added and not removed:
+            return
+        
+        if removed:
+            self.remove_image_files(removed)
+        
+        def run(job, db):
+            if added:
+                db.register_images(added)
+            moved = db.reconcile(identities) if identities else []
+            if removed:
+                db.delete_unlabeled(removed)
+            db.commit()
+            return moved
+        self.start_job(Job('sync', "正在同步文件夹", run, self.db, reads={'files'}),
+                       lambda moved, error, cancelled: self.on_sync_applied(added, removed, moved, error))
+    
+    def on_sync_applied(self, added, removed, moved, error):
+        if moved:
+            self.db.rename_pending(dict(moved))
+        self.flush_tag_changes()
+        if added:
+            self.thumbnail_model.append_rows(added)
+            self.show_first_image()
+        
+        self.duplicate_index = None
+        if moved:
+            self.thumbnail_model.refresh_all()
+            self.refresh_tag_list()
+        self.update_filter_count()
         self.update_status()
-        self.btn_load_more.setEnabled(self.loaded_count < len(self.image_files))
+        if error is not None:
+            self.set_operation_status(f"同步文件夹失败: {error}")
+            return
+        self.set_operation_status(f"文件夹已同步: 新增 {len(added)} 张，移除 {len(removed)} 张")
+            
+    def show_first_image(self):
+        if not self.image_files:
+            return
+        row = 0
+        if self.resume_path is not None:
+            row = self.image_files.index_of(self.resume_path)
+            if row is None:
+                if self.scanner is not None:
+                    return
+                row = min(self.resume_index, len(self.image_files) - 1)
+            self.resume_path = None
+        elif self.current_index != -1:
+            return
+        self.current_index = row
+        self.show_current_image()
         self.btn_rename.setEnabled(True)
         self.btn_organize.setEnabled(True)
         self.btn_delete.setEnabled(True)
+        self.btn_index_hashes.setEnabled(not self.scheduler.has('hash'))
         
+    def schedule_show(self):
+        self.show_timer.start()
+    
     def show_current_image(self):
+        self.show_timer.stop()
         if 0 <= self.current_index < len(self.image_files):
-            image_path = self.image_files[self.current_index]
-            pixmap = QPixmap(image_path)
-            
-            if not pixmap.isNull():
-                self.image_viewer.set_image(pixmap)
-                
-                self.current_image_name = os.path.basename(image_path)
+            with PROFILER.span("show"):
+                image_path = self.image_files[self.current_index]
+                decoded = self.image_cache.get(image_path)
                 
-                cursor = self.db_conn.cursor()
-                cursor.execute("SELECT tags FROM images WHERE path = ?", (image_path,))
-                result = cursor.fetchone()
-                tags = result[0].split(',') if result and result[0] else []
-                
-                self.tag_list.clear()
-                for tag in tags:
-                    if tag:  
-                        item = QListWidgetItem(tag)
-                        item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
-                        item.setCheckState(Qt.Unchecked)
-                        self.tag_list.addItem(item)
-                
-                self.toggle_default_tag()
-                self.update_status()
+                self.prefetcher.target_size = self.image_viewer.decode_size()
+                self.prefetcher.prefetch(self.image_files, self.current_index, previews_only=self.skimming)
+                if decoded is None:
+                    self.pending_image_path = image_path
+                    self.show_started = time.perf_counter()
+                    preview = self.prefetcher.previews.get(image_path)
+                    if preview is not None and image_path != self.displayed_path:
+                        self.display_image(image_path, preview, preview=True)
+                else:
+                    self.pending_image_path = ""
+                    self.display_image(image_path, decoded)
+                if self.skimming:
+                    self.full_decode_timer.start()
+                self.update_cache_status()
+    
+    def stop_skimming(self):
+        self.full_decode_timer.stop()
+        if self.skimming:
+            self.skimming = False
+            if self.pending_image_path and not self.show_timer.isActive():
+                self.prefetcher.prefetch(self.image_files, self.current_index)
+    
+    def on_preview_ready(self, path):
+        if path == self.pending_image_path and path != self.displayed_path:
+            preview = self.prefetcher.previews.peek(path)
+            if preview is not None:
+                self.display_image(path, preview, preview=True)
+                PROFILER.record("time_to_preview", self.show_started, time.perf_counter() - self.show_started)
+    
+    def on_image_ready(self, path):
+        if path == self.pending_image_path:
+            self.pending_image_path = ""
+            decoded = self.image_cache.peek(path)
+            if decoded is not None:
+                self.display_image(path, decoded)
+                PROFILER.record("time_to_image", self.show_started, time.perf_counter() - self.show_started)
+        self.update_cache_status()
+    
+    def display_image(self, image_path, decoded, preview=False):
+        upgrade = image_path == self.displayed_path and self.displayed_preview
+        with PROFILER.span("set_image"):
+            self.image_viewer.set_image(decoded.pixmap, image_path, decoded.source_size, decoded.tileable,
+                                        keep_view=upgrade)
+        self.displayed_path = image_path
+        self.displayed_preview = preview
+        if upgrade:
+            return
+        
+        index = self.thumbnail_model.index(self.current_index)
+        selection = self.thumbnail_view.selectionModel()
+        selection.setCurrentIndex(index, QItemSelectionModel.NoUpdate if selection.isSelected(index)
+                                  else QItemSelectionModel.ClearAndSelect)
+        self.thumbnail_view.scrollTo(index)
+        
+        self.current_image_name = os.path.basename(image_path)
+        
+        self.duplicate_list.clear()
+        self.refresh_tag_list()
+        self.toggle_default_tag()
+        self.update_status()
+    
+    def refresh_tag_list(self):
+        self.tag_list.clear()
+        if not 0 <= self.current_index < len(self.image_files):
+            return
+        with PROFILER.span("select_tags"):
+            tags = self.db.get_tags(self.image_files[self.current_index])
+        with PROFILER.span("tag_list"):
+            for tag in tags:
+                item = QListWidgetItem(tag)
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(Qt.Unchecked)
+                self.tag_list.addItem(item)
+    
+    def update_cache_status(self):
+        cache = self.image_cache
+        self.cache_label.setText(
+            f"缓存: 命中 {cache.hits} / 未命中 {cache.misses} | "
+            f"{cache.current_bytes / (1024 * 1024):.0f}/{cache.max_bytes / (1024 * 1024):.0f} MB"
+        )
     
     def update_status(self):
         if self.image_files:
             self.status_label.setText(
                 f"图片: {self.current_index + 1}/{len(self.image_files)} | "
-                f"文件名: {self.current_image_name} | "
-                f"已加载: {self.loaded_count}/{len(self.image_files)}"
+                f"文件名: {self.current_image_name}"
             )
             self.update_zoom_status()
         else:
@@ -505,43 +1681,119 @@ class ImageTaggingApp(QMainWindow):
         self.operation_label.setText(message)
     
     def show_next_image(self):
-        if self.image_files and self.current_index < len(self.image_files) - 1:
+        if self.query_cursor is not None:
+            self.show_filtered_image(forward=True)
+        elif self.image_files and self.current_index < len(self.image_files) - 1:
+            self.flush_tag_changes()
             self.current_index += 1
-            self.show_current_image()
+            self.schedule_show()
     
     def show_prev_image(self):
-        if self.image_files and self.current_index > 0:
+        if self.query_cursor is not None:
+            self.show_filtered_image(forward=False)
+        elif self.image_files and self.current_index > 0:
+            self.flush_tag_changes()
             self.current_index -= 1
+            self.schedule_show()
+    
+    def find_filtered_image(self, path, forward, inclusive=False):
+        while True:
+            if forward:
+                path = self.query_cursor.next_after(path, inclusive)
+            else:
+                path = self.query_cursor.prev_before(path)
+            if path is None:
+                return None
+            index = self.image_files.index_of(path)
+            if index is not None:
+                return index
+            inclusive = False
+    
+    def show_filtered_image(self, forward, inclusive=False):
+        if not self.image_files:
+            return
+        self.flush_tag_changes()
+        current_path = self.image_files[self.current_index] if self.current_index >= 0 else None
+        index = self.find_filtered_image(current_path, forward, inclusive)
+        if index is None:
+            self.set_operation_status("已到最后一张匹配图片" if forward else "已到第一张匹配图片")
+            return
+        if index != self.current_index:
+            self.current_index = index
+            self.schedule_show()
+    
+    def apply_filter(self):
+        expression = self.filter_input.text().strip()
+        if not expression:
+            self.query_cursor = None
+            self.filter_label.setText("未筛选")
+            return
+        self.flush_tag_changes()
+        try:
+            self.query_cursor = QueryCursor(self.db, expression, self.image_folder or None)
+        except ValueError as e:
+            self.query_cursor = None
+            self.filter_label.setText(f"查询错误: {e}")
+            return
+        self.update_filter_count()
+        self.show_filtered_image(forward=True, inclusive=True)
+    
+    def update_filter_count(self):
+        if self.query_cursor is not None:
+            self.query_cursor.invalidate()
+            self.filter_label.setText(f"匹配: {self.query_cursor.count()} 张")
+    
+    def on_thumbnail_clicked(self, index):
+        if index.row() != self.current_index:
+            self.flush_tag_changes()
+            self.current_index = index.row()
             self.show_current_image()
     
-    def add_tag(self):
+    def schedule_flush(self):
+        if self.flush_timer.interval() <= 0:
+            self.flush_tag_changes()
+        elif not self.flush_timer.isActive():
+            self.flush_timer.start()
+    
+    def tags_locked(self):
+        return any(self.scheduler.has(name) for name in ('rename', 'register', 'reconcile', 'sync'))
+    
+    def flush_tag_changes(self):
+        self.flush_timer.stop()
+        if self.tags_locked():
+            return
+        if self.db.has_pending():
+            try:
+                with PROFILER.span("flush"):
+                    self.db.flush()
+            except sqlite3.Error as e:
+                self.set_operation_status(f"保存标签失败，稍后重试: {e}")
+                QTimer.singleShot(1000, self.flush_tag_changes)
+                return
+            self.update_filter_count()
+    
+    def input_tag(self):
         tag = self.new_tag_input.text().strip()
+        if not tag and self.default_tag and self.use_default_check.isChecked():
+            tag = self.default_tag
+        return tag
+    
+    def add_tag(self):
+        tag = self.input_tag()
         if not tag:
-            if self.default_tag and self.use_default_check.isChecked():
-                tag = self.default_tag
-            else:
-                return  
+            return  
             
         if self.current_index >= 0:
-            item = QListWidgetItem(tag)
-            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
-            item.setCheckState(Qt.Unchecked)
-            self.tag_list.addItem(item)
-            
-            image_path = self.image_files[self.current_index]
-            cursor = self.db_conn.cursor()
-            cursor.execute("SELECT tags FROM images WHERE path = ?", (image_path,))
-            result = cursor.fetchone()
-            current_tags = result[0].split(',') if result and result[0] else []
-            
-            if tag not in current_tags:
-                current_tags.append(tag)
-                new_tags = ','.join(current_tags)
-                cursor.execute(
-                    "UPDATE images SET tags = ? WHERE path = ?",
-                    (new_tags, image_path)
-                )
-                self.db_conn.commit()
+            with PROFILER.span("add_tag"):
+                item = QListWidgetItem(tag)
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(Qt.Unchecked)
+                self.tag_list.addItem(item)
+                
+                image_path = self.image_files[self.current_index]
+                self.db.add_tag(image_path, tag)
+                self.thumbnail_model.refresh_row(self.current_index)
+                self.schedule_flush()
             
             if self.use_default_check.isChecked():
                 self.new_tag_input.setText(self.default_tag)
@@ -550,144 +1802,371 @@ class ImageTaggingApp(QMainWindow):
     
     def remove_tag(self, item):
         if item.checkState() == Qt.Checked:
-            tag = item.text()
-            row = self.tag_list.row(item)
-            self.tag_list.takeItem(row)
-
-            image_path = self.image_files[self.current_index]
-            cursor = self.db_conn.cursor()
-            cursor.execute("SELECT tags FROM images WHERE path = ?", (image_path,))
-            result = cursor.fetchone()
-            if result and result[0]:
-                current_tags = result[0].split(',')
-                if tag in current_tags:
-                    current_tags.remove(tag)
-                    new_tags = ','.join(current_tags)
-                    cursor.execute(
-                        "UPDATE images SET tags = ? WHERE path = ?",
-                        (new_tags, image_path)
-                    )
-                    self.db_conn.commit()
+            with PROFILER.span("remove_tag"):
+                tag = item.text()
+                row = self.tag_list.row(item)
+                self.tag_list.takeItem(row)
+
+                image_path = self.image_files[self.current_index]
+                self.db.remove_tag(image_path, tag)
+                self.thumbnail_model.refresh_row(self.current_index)
+                self.schedule_flush()
+    
+    def bulk_tag(self, add):
+        tag = self.input_tag()
+        if not tag or not self.image_files:
+            return
+        if self.tags_locked():
+            self.set_operation_status("正在批量重命名或登记图片，请稍候")
+            return
+        scope = self.bulk_scope.currentData()
+        self.flush_tag_changes()
+        if scope == "query" and self.query_cursor is None:
+            self.set_operation_status("请先在筛选框中输入查询")
+            return
+        
+        with PROFILER.span("bulk_tag"):
+            if scope == "query":
+                count = self.query_cursor.add_tag(tag) if add else self.query_cursor.remove_tag(tag)
+            else:
+                if scope == "selection":
+                    rows = sorted(index.row() for index in self.thumbnail_view.selectionModel().selectedIndexes())
+                else:
+                    radius = self.bulk_radius.value()
+                    rows = range(max(0, self.current_index - radius),
+                                 min(len(self.image_files), self.current_index + radius + 1))
+                paths = [self.image_files[row] for row in rows]
+                count = self.db.add_tag_many(paths, tag) if add else self.db.remove_tag_many(paths, tag)
+            self.db.commit()
+        
+        self.thumbnail_model.refresh_all()
+        self.refresh_tag_list()
+        self.update_filter_count()
+        if add:
+            self.set_operation_status(f"已为 {count} 张图片添加标签: {tag}")
+        else:
+            self.set_operation_status(f"已从 {count} 张图片移除标签: {tag}")
     
     def batch_rename(self):
         prefix = self.rename_prefix.text().strip()
         if not prefix:
             return
-            
-        cursor = self.db_conn.cursor()
-        renamed_count = 0
+        if self.is_scanning() or self.reconcile_worker is not None or self.scheduler.has('register'):
+            self.set_operation_status("正在扫描图片，请稍候")
+            return
+        if self.scheduler.has('rename'):
+            return
         
-        for i, old_path in enumerate(self.image_files):
-            ext = os.path.splitext(old_path)[1]
-            new_name = f"{prefix}_{i+1:04d}{ext}"
-            new_path = os.path.join(self.image_folder, new_name)
-            
-            if os.path.exists(old_path):
-                os.rename(old_path, new_path)
-                renamed_count += 1
-                
-                cursor.execute(
-                    "UPDATE images SET path = ? WHERE path = ?",
-                    (new_path, old_path)
-                )
-                
-                if old_path == self.image_files[self.current_index]:
-                    self.current_image_name = new_name
-                    self.update_status()
-        
-        self.db_conn.commit()
-        self.image_files = [
-            os.path.join(self.image_folder, f) for f in os.listdir(self.image_folder) 
-            if os.path.isfile(os.path.join(self.image_folder, f)) and 
-            f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))
-        ]
-        self.set_operation_status(f"批量重命名完成，共重命名 {renamed_count} 张图片")
+        paths = self.image_files.copy()
+        
+        def run(job, db):
+            return rename_images(db, paths, prefix, job.cancelled, job.progress)
+        self.btn_rename.setEnabled(False)
+        self.start_job(Job('rename', "正在批量重命名", run, self.db, writes={'files'}), self.on_rename_completed)
+    
+    def on_rename_completed(self, renamed, error, cancelled):
+        self.btn_rename.setEnabled(True)
+        if isinstance(error, OSError):
+            if self.db.pending_rename_batches():
+                self.set_operation_status(f"批量重命名中断，重新打开文件夹时可继续或回滚: {error}")
+            else:
+                self.set_operation_status(f"批量重命名失败，已回滚: {error}")
+            self.flush_tag_changes()
+            return
+        if error is not None:
+            self.set_operation_status(f"批量重命名失败: {error}")
+            self.flush_tag_changes()
+            return
+        if not renamed:
+            self.set_operation_status("批量重命名已取消" if cancelled else "没有需要重命名的图片")
+            self.flush_tag_changes()
+            return
+        
+        self.db.rename_pending(dict(renamed))
+        self.apply_renames(renamed)
+        self.flush_tag_changes()
+        self.set_operation_status(f"批量重命名完成，共重命名 {len(renamed)} 张图片")
+    
+    def apply_renames(self, renamed):
+        rows = [(self.image_files.index_of(old_path), new_path) for old_path, new_path in renamed]
+        for row, new_path in rows:
+            if row is not None:
+                self.image_files[row] = new_path
+        
+        decoded_images = [(new_path, self.image_cache.peek(old_path)) for old_path, new_path in renamed]
+        for old_path, new_path in renamed:
+            self.image_cache.discard(old_path)
+            self.image_cache.discard(new_path)
+        for new_path, decoded in decoded_images:
+            if decoded is not None:
+                self.image_cache.put(new_path, decoded)
+        
+        self.duplicate_index = None
+        self.thumbnail_model.refresh_all()
+        self.update_filter_count()
+        if 0 <= self.current_index < len(self.image_files):
+            self.current_image_name = os.path.basename(self.image_files[self.current_index])
+        self.update_status()
+    
+    def recover_renames(self):
+        for batch_id in self.db.pending_rename_batches():
+            answer = QMessageBox.question(
+                self, "未完成的批量重命名",
+                "上次批量重命名未完成。\n选择\"是\"继续完成重命名，选择\"否\"回滚到原文件名。",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            try:
+                renamed = run_rename_batch(self.db, batch_id, rollback=answer != QMessageBox.Yes)
+            except OSError as error:
+                self.set_operation_status(f"恢复批量重命名失败: {error}")
+                continue
+            if renamed:
+                self.set_operation_status(f"已继续完成批量重命名，共 {len(renamed)} 张图片")
+            else:
+                self.set_operation_status("已回滚未完成的批量重命名")
     
     def organize_images(self):
         if not self.image_folder:
             return
             
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT path, tags FROM images WHERE tags != ''")
-        tagged_images = cursor.fetchall()
+        if self.scheduler.has('organize'):
+            return
         
-        organized_count = 0
-        for path, tags in tagged_images:
-            if not os.path.exists(path):
-                continue
-                
-            for tag in tags.split(','):
-                if not tag:
-                    continue
-                    
-                tag_folder = os.path.join(self.image_folder, tag)
-                os.makedirs(tag_folder, exist_ok=True)
-                
-                dest_path = os.path.join(tag_folder, os.path.basename(path))
-                if not os.path.exists(dest_path):
-                    shutil.copy2(path, dest_path)
-                    organized_count += 1
+        root, mode, radius = self.image_folder, self.organize_mode.currentData(), self.duplicate_radius
+        skip_duplicates = self.skip_duplicates_check.isChecked()
+        
+        def run(job, db):
+            return organize_dataset(db, root, mode, cancelled=job.cancelled, progress=job.progress,
+                                    radius=radius if skip_duplicates else None)
+        self.btn_organize.setEnabled(False)
+        self.start_job(Job('organize', "正在整理已标记图片", run, self.db, reads={'files'}), self.on_organize_completed)
+    
+    def start_job(self, job, on_finished):
+        self.flush_tag_changes()
+        self.progress_bar.setValue(0)
+        self.scheduler.submit(job, on_finished)
+    
+    def update_job_status(self):
+        busy = self.scheduler.busy()
+        self.progress_bar.setVisible(busy)
+        self.btn_pause.setVisible(busy)
+        self.btn_cancel.setVisible(busy)
+        self.btn_pause.setText("继续" if self.scheduler.paused else "暂停")
+        if not busy:
+            return
+        message = "、".join(job.label for job in self.scheduler.running) + "..."
+        if self.scheduler.queued:
+            message += f" (排队 {len(self.scheduler.queued)} 个)"
+        if self.scheduler.paused:
+            message = "已暂停: " + message
+        self.set_operation_status(message)
+    
+    def toggle_pause(self):
+        self.scheduler.set_paused(not self.scheduler.paused)
+    
+    def on_operation_progress(self, done, total):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+    
+    def on_organize_completed(self, result, error, cancelled):
+        self.btn_organize.setEnabled(True)
+        if error is not None:
+            self.set_operation_status(f"整理失败: {error}")
+            return
+        organized_count, removed_count, failed_count, skipped_count = result or (0, 0, 0, 0)
         
-        self.set_operation_status(f"已整理 {organized_count} 张标记图片到对应文件夹")
+        message = f"已整理 {organized_count} 张标记图片到对应文件夹"
+        if removed_count:
+            message += f"，移除已取消标签的图片 {removed_count} 张"
+        if skipped_count:
+            message += f"，跳过 {skipped_count} 张（相似图片、源文件缺失或同名文件）"
+        if failed_count:
+            message += f"，失败 {failed_count} 张"
+        if cancelled:
+            message = "整理已取消，" + message
+        self.set_operation_status(message)
+    
+    def index_hashes(self):
+        if self.scheduler.has('hash'):
+            return
+        
+        def run(job, db):
+            return index_perceptual_hashes(db, cancelled=job.cancelled, progress=job.progress)
+        self.btn_index_hashes.setEnabled(False)
+        self.start_job(Job('hash', "正在计算感知哈希", run, self.db, reads={'files'}), self.on_hashes_completed)
+    
+    def on_hashes_completed(self, result, error, cancelled):
+        self.btn_index_hashes.setEnabled(True)
+        self.duplicate_index = None
+        if error is not None:
+            self.set_operation_status(str(error))
+            return
+        done, failed = result or (0, 0)
+        if done or failed:
+            message = f"已为 {done} 张图片建立相似图片索引"
+            if failed:
+                message += f"，无法读取 {failed} 张"
+            self.set_operation_status("索引已取消，" + message if cancelled else message)
+        elif cancelled:
+            self.set_operation_status("索引已取消")
+        else:
+            self.set_operation_status("相似图片索引已是最新")
+    
+    def find_duplicates(self):
+        self.duplicate_list.clear()
+        if self.current_index < 0:
+            return
+        if self.duplicate_index is None:
+            self.duplicate_index = DuplicateIndex(self.db)
+        image_path = self.image_files[self.current_index]
+        if image_path not in self.duplicate_index.hashes:
+            self.set_operation_status("当前图片尚未建立相似图片索引")
+            return
+        duplicates = self.duplicate_index.near_duplicates(image_path, self.duplicate_radius)
+        for distance, path in duplicates:
+            item = QListWidgetItem(f"{os.path.basename(path)} (距离 {distance})")
+            item.setData(Qt.UserRole, path)
+            self.duplicate_list.addItem(item)
+        self.set_operation_status(f"找到 {len(duplicates)} 张相似图片")
+    
+    def on_duplicate_clicked(self, item):
+        index = self.image_files.index_of(item.data(Qt.UserRole))
+        if index is None:
+            self.set_operation_status("该图片不在当前文件夹列表中")
+        elif index != self.current_index:
+            self.flush_tag_changes()
+            self.current_index = index
+            self.show_current_image()
+    
+    def propagate_tags(self):
+        if self.current_index < 0 or not self.duplicate_list.count():
+            return
+        if self.tags_locked():
+            self.set_operation_status("正在批量重命名或登记图片，请稍候")
+            return
+        self.flush_tag_changes()
+        tags = self.db.get_tags(self.image_files[self.current_index])
+        paths = [self.duplicate_list.item(i).data(Qt.UserRole) for i in range(self.duplicate_list.count())]
+        for tag in tags:
+            self.db.add_tag_many(paths, tag)
+        self.db.commit()
+        self.thumbnail_model.refresh_all()
+        self.update_filter_count()
+        self.set_operation_status(f"已将 {len(tags)} 个标签同步到 {len(paths)} 张相似图片")
     
     def delete_unlabeled(self):
         if not self.image_folder:
             return
+        if self.is_scanning():
+            self.set_operation_status("正在扫描图片，请稍候")
+            return
             
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT path FROM images WHERE tags = ''")
-        unlabeled_images = [row[0] for row in cursor.fetchall()]
-        
-        deleted_count = 0
-        for path in unlabeled_images:
-            if os.path.exists(path):
-                os.remove(path)
-                deleted_count += 1
-                
-            cursor.execute("DELETE FROM images WHERE path = ?", (path,))
-            
-            if self.image_files and path == self.image_files[self.current_index]:
-                self.current_image_name = ""
+        if self.scheduler.has('delete'):
+            return
         
-        self.db_conn.commit()
+        files = self.image_files.copy()
+
+        def run(job, db):
+            paths = [path for path in db.unlabeled_paths() if path in files]
+            return delete_files(paths, True, cancelled=job.cancelled, progress=job.progress)
+        self.btn_delete.setEnabled(False)
+        self.start_job(Job('delete', "正在统计未标记图片", run, self.db, reads={'files'}),
+                       lambda result, error, cancelled: self.on_delete_completed(result, error, cancelled, True))
+    
+    def start_delete(self, paths):
+        self.flush_tag_changes()
+        files = self.image_files.copy()
+        held = set(self.db.pending)
+
+        def run(job, db):
+            unlabeled = set(db.unlabeled_paths())
+            targets = [path for path in paths if path in unlabeled and path in files and path not in held]
+            removed, total_bytes, failed = delete_files(targets, False, cancelled=job.cancelled, progress=job.progress)
+            db.delete_unlabeled(removed)
+            return removed, total_bytes, failed
+        self.btn_delete.setEnabled(False)
+        self.start_job(Job('delete', "正在删除未标记图片", run, self.db, writes={'files'}),
+                       lambda result, error, cancelled: self.on_delete_completed(result, error, cancelled, False))
+    
+    def on_delete_completed(self, result, error, cancelled, dry_run):
+        self.btn_delete.setEnabled(True)
+        if error is not None:
+            self.set_operation_status(f"删除未标记图片失败: {error}")
+            return
+        paths, total_bytes, failed_count = result or ([], 0, 0)
         
-        self.image_files = [
-            f for f in self.image_files if os.path.exists(f)
-        ]
+        if dry_run:
+            if cancelled:
+                self.set_operation_status("已取消删除未标记图片")
+                return
+            answer = QMessageBox.question(
+                self, "删除未标记图片",
+                f"将删除 {len(paths)} 张未标记图片，释放 {total_bytes / (1024 * 1024):.1f} MB 空间。\n确定要删除吗？",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if answer == QMessageBox.Yes:
+                self.start_delete(paths)
+            else:
+                self.set_operation_status(
+                    f"预览: {len(paths)} 张未标记图片，共 {total_bytes / (1024 * 1024):.1f} MB")
+            return
+        
+        self.remove_image_files(paths)
+        
+        message = f"已删除 {len(paths)} 张未标记图片，释放 {total_bytes / (1024 * 1024):.1f} MB"
+        if failed_count:
+            message += f"，失败 {failed_count} 张"
+        if cancelled:
+            message = "删除已取消，" + message
+        self.set_operation_status(message)
+    
+    def remove_image_files(self, paths):
+        removed = set(paths)
+        if not removed:
+            return
+        for path in removed:
+            self.image_cache.discard(path)
+        
+        rows = self.thumbnail_model.remove_paths(removed)
+        current_index = max(0, self.current_index - bisect.bisect_left(rows, self.current_index))
+        self.duplicate_index = None
+        self.update_filter_count()
         
         if self.image_files:
-            if self.current_index >= len(self.image_files):
-                self.current_index = len(self.image_files) - 1
+            self.current_index = min(current_index, len(self.image_files) - 1)
             self.show_current_image()
         else:
-            self.image_viewer.scene.clear()
+            self.current_index = -1
+            self.image_viewer.set_image(QPixmap())
+            self.displayed_path = ""
             self.tag_list.clear()
             self.status_label.setText("无图片")
             self.current_image_name = ""
         
-        self.set_operation_status(f"已删除 {deleted_count} 张未标记图片")
-        
     def zoom_in(self):
         if self.image_viewer.pixmap_item:
-            zoom_factor = 1.15
-            new_scale = self.image_viewer.current_scale * zoom_factor
-            if new_scale <= self.image_viewer.max_scale:
-                self.image_viewer.scale(zoom_factor, zoom_factor)
-                self.image_viewer.current_scale = new_scale
-                self.update_zoom_status()
+            self.image_viewer.zoom(1.15)
     
     def zoom_out(self):
         if self.image_viewer.pixmap_item:
-            zoom_factor = 1.15
-            new_scale = self.image_viewer.current_scale / zoom_factor
-            if new_scale >= self.image_viewer.min_scale:
-                self.image_viewer.scale(1 / zoom_factor, 1 / zoom_factor)
-                self.image_viewer.current_scale = new_scale
-                self.update_zoom_status()
+            self.image_viewer.zoom(1 / 1.15)
     
     def reset_zoom(self):
         self.image_viewer.reset_zoom()
         self.update_zoom_status()
+    
+    def closeEvent(self, event):
+        self.save_position()
+        self.watcher.blockSignals(True)
+        self.sync_timer.stop()
+        self.stop_scanner()
+        for job in self.scheduler.shutdown():
+            if job.name in ('rename', 'reconcile', 'sync') and job.result:
+                self.db.rename_pending(dict(job.result))
+        self.flush_tag_changes()
+        self.db.close()
+        self.prefetcher.shutdown()
+        self.image_viewer.tile_loader.shutdown()
+        self.thumbnail_model.shutdown()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication([])
@@ -0,0 +1,410 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from image_label_core import (DatasetRegistry, QueryCursor, TagDatabase, iter_image_files, organize_dataset, delete_files)
+
+GUI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Image Label Management System.py")
+CORE_BENCHMARKS = ('scan', 'register', 'tag', 'query', 'organize', 'reorganize', 'delete')
+GUI_BENCHMARKS = ('open_folder', 'register_folder', 'reopen_folder', 'navigate', 'skim', 'add_tag', 'large_images')
+BENCHMARKS = CORE_BENCHMARKS + GUI_BENCHMARKS
+SAMPLE_LIMIT = 500
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+    return {'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': ordered[-1] * 1000,
+            'mean': sum(ordered) / len(ordered) * 1000}
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(GUI_SCRIPT), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def encode_image(width, height, seed):
+    from PySide6.QtCore import QBuffer, QByteArray, QIODevice
+    from PySide6.QtGui import QColor, QImage, QPainter
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(QColor(seed * 37 % 256, seed * 91 % 256, seed * 53 % 256))
+    painter = QPainter(image)
+    step = max(1, width // 16)
+    for x in range(0, width, step * 2):
+        painter.fillRect(x, 0, step, height, QColor((x + seed * 11) % 256, 120, 200))
+    painter.end()
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, "JPG", 85)
+    return bytes(data)
+
+def make_dataset(workdir, name, count, width, height):
+    folder = os.path.join(workdir, name)
+    marker = os.path.join(folder, ".complete")
+    if os.path.exists(marker):
+        return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    variants = [encode_image(width, height, seed) for seed in range(min(count, 16))]
+    for i in range(count):
+        with open(os.path.join(folder, f"img_{i:07d}.jpg"), "wb") as f:
+            f.write(variants[i % len(variants)])
+    open(marker, "w").close()
+    return folder
+
+def make_database(folder):
+    path = folder + ".shard.db"
+    if os.path.exists(path):
+        return path
+    db = TagDatabase(path + ".tmp", root=folder)
+    paths = sorted(iter_image_files(folder))
+    db.register_images(paths)
+    db.add_tag_many(paths[::10], "defect")
+    db.add_tag_many(paths[::20], "reviewed")
+    db.add_tag_many(paths[::5], "cat")
+    db.commit()
+    db.close()
+    os.replace(path + ".tmp", path)
+    return path
+
+def copy_database(path, workdir):
+    copy = os.path.join(workdir, "bench.db")
+    shutil.copyfile(path, copy)
+    return copy
+
+def bench_scan(folder, db_path, workdir):
+    seconds, paths = timed(lambda: list(iter_image_files(folder)))
+    return {'count': len(paths), 'seconds': seconds}
+
+def bench_register(folder, db_path, workdir):
+    paths = list(iter_image_files(folder))
+    db = TagDatabase(os.path.join(workdir, "register.db"), root=folder)
+    start = time.perf_counter()
+    for i in range(0, len(paths), 10000):
+        db.register_images(paths[i:i + 10000])
+    db.commit()
+    seconds = time.perf_counter() - start
+    db.close()
+    return {'count': len(paths), 'seconds': seconds}
+
+def bench_tag(folder, db_path, workdir):
+    db = TagDatabase(copy_database(db_path, workdir), root=folder)
+    paths = sorted(iter_image_files(folder))
+    samples = []
+    for path in paths[:SAMPLE_LIMIT]:
+        start = time.perf_counter()
+        db.add_tag(path, "single")
+        db.flush()
+        db.commit()
+        samples.append(time.perf_counter() - start)
+    seconds, count = timed(db.add_tag_many, paths, "bulk")
+    db.commit()
+    db.close()
+    return {'count': count, 'seconds': seconds, 'samples': samples}
+
+def bench_query(folder, db_path, workdir):
+    db = TagDatabase(copy_database(db_path, workdir), root=folder)
+    cursor = QueryCursor(db, "defect AND NOT reviewed OR cat*", folder)
+    count_seconds, count = timed(cursor.count)
+    samples = []
+    path = None
+    for _ in range(SAMPLE_LIMIT):
+        step, path = timed(cursor.next_after, path)
+        samples.append(step)
+        if path is None:
+            break
+    db.close()
+    return {'count': count, 'seconds': count_seconds, 'samples': samples}
+
+def bench_organize(folder, db_path, workdir):
+    db = TagDatabase(copy_database(db_path, workdir), root=folder)
+    root = os.path.join(workdir, "organized")
+    seconds, (organized, _, failed, _) = timed(organize_dataset, db, root, 'hardlink')
+    db.close()
+    return {'count': organized, 'failed': failed, 'seconds': seconds}
+
+def bench_reorganize(folder, db_path, workdir):
+    db = TagDatabase(copy_database(db_path, workdir), root=folder)
+    root = os.path.join(workdir, "organized")
+    organize_dataset(db, root, 'hardlink')
+    paths = sorted(iter_image_files(folder))[:SAMPLE_LIMIT]
+    for path in paths[::2]:
+        db.add_tag(path, "session")
+    for path in paths[1::2]:
+        for tag in db.get_tags(path):
+            db.remove_tag(path, tag)
+    db.commit()
+    seconds, (organized, removed, failed, _) = timed(organize_dataset, db, root, 'hardlink')
+    db.close()
+    return {'count': organized + removed, 'failed': failed, 'seconds': seconds}
+
+def bench_delete(folder, db_path, workdir):
+    db = TagDatabase(copy_database(db_path, workdir), root=folder)
+    paths = db.unlabeled_paths()
+    db.close()
+    seconds, (existing, total_bytes, failed) = timed(delete_files, paths, True)
+    return {'count': len(existing), 'failed': failed, 'seconds': seconds}
+
+def start_gui(folder, workdir, db_path):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    os.environ["XDG_CACHE_HOME"] = workdir
+    os.environ["IMAGE_LABEL_HOME"] = workdir
+    registry = DatasetRegistry()
+    registry.add(folder, copy_database(db_path, workdir))
+    registry.close()
+    from PySide6.QtCore import QSettings
+    from PySide6.QtWidgets import QApplication
+    for settings_format in (QSettings.NativeFormat, QSettings.IniFormat):
+        QSettings.setPath(settings_format, QSettings.UserScope, workdir)
+    app = QApplication.instance() or QApplication([])
+    spec = importlib.util.spec_from_file_location("image_label_gui", GUI_SCRIPT)
+    gui = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gui)
+    os.chdir(workdir)
+    return app, gui
+
+def wait_for(app, condition, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("等待界面操作超时")
+        app.processEvents()
+        time.sleep(0.0005)
+
+def open_window(app, gui, folder):
+    gui.QFileDialog.getExistingDirectory = lambda *args, **kwargs: folder
+    window = gui.ImageTaggingApp()
+    window.resize(1200, 800)
+    window.show()
+    start = time.perf_counter()
+    window.open_image_folder()
+    wait_for(app, lambda: window.image_viewer.pixmap_item is not None and not window.pending_image_path)
+    first_image = time.perf_counter() - start
+    wait_for(app, lambda: not window.is_scanning())
+    return window, first_image, time.perf_counter() - start
+
+def image_shown(window):
+    return lambda: not window.pending_image_path and not window.show_timer.isActive()
+
+def bench_open_folder(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    window, first_image, seconds = open_window(app, gui, folder)
+    count = len(window.image_files)
+    window.close()
+    return {'count': count, 'seconds': seconds, 'samples': [first_image]}
+
+def bench_register_folder(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    gui.QFileDialog.getExistingDirectory = lambda *args, **kwargs: folder
+    window = gui.ImageTaggingApp()
+    window.resize(1200, 800)
+    window.show()
+    registered = []
+    on_register_completed = window.on_register_completed
+
+    def record_register(*args):
+        registered.append(time.perf_counter())
+        on_register_completed(*args)
+    window.on_register_completed = record_register
+    start = time.perf_counter()
+    window.open_image_folder()
+    wait_for(app, lambda: window.scanner is None)
+    scanned = time.perf_counter() - start
+    wait_for(app, lambda: registered)
+    seconds = registered[0] - start
+    count = len(window.image_files)
+    window.close()
+    return {'count': count, 'seconds': seconds, 'samples': [scanned, seconds]}
+
+def bench_reopen_folder(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    window, _, _ = open_window(app, gui, folder)
+    wait_for(app, lambda: window.scanner is None and not window.scheduler.busy() and window.reconcile_worker is None)
+    window.close()
+    window, first_image, scanned = open_window(app, gui, folder)
+    start = time.perf_counter()
+    wait_for(app, lambda: window.scanner is None and not window.scheduler.busy() and window.reconcile_worker is None)
+    seconds = scanned + time.perf_counter() - start
+    count = len(window.image_files)
+    window.close()
+    return {'count': count, 'seconds': seconds, 'samples': [first_image, scanned]}
+
+def bench_navigate(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    window, _, _ = open_window(app, gui, folder)
+    samples = []
+    for _ in range(min(SAMPLE_LIMIT, len(window.image_files) - 1)):
+        start = time.perf_counter()
+        window.show_next_image()
+        wait_for(app, image_shown(window))
+        samples.append(time.perf_counter() - start)
+    window.close()
+    return {'count': len(samples), 'seconds': sum(samples), 'samples': samples}
+
+def bench_skim(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    window, _, _ = open_window(app, gui, folder)
+    samples = []
+    start = time.perf_counter()
+    for i in range(min(SAMPLE_LIMIT, len(window.image_files) - 1)):
+        step = time.perf_counter()
+        gui.QApplication.sendEvent(window, gui.QKeyEvent(gui.QEvent.KeyPress, gui.Qt.Key_D, gui.Qt.NoModifier, "d", i > 0))
+        wait_for(app, lambda: not window.show_timer.isActive())
+        samples.append(time.perf_counter() - step)
+    release = time.perf_counter()
+    gui.QApplication.sendEvent(window, gui.QKeyEvent(gui.QEvent.KeyRelease, gui.Qt.Key_D, gui.Qt.NoModifier, "d"))
+    wait_for(app, image_shown(window))
+    settle = time.perf_counter() - release
+    window.close()
+    return {'count': len(samples), 'seconds': time.perf_counter() - start, 'samples': samples,
+            'settle_ms': settle * 1000}
+
+def bench_add_tag(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    window, _, _ = open_window(app, gui, folder)
+    samples = []
+    for i in range(min(SAMPLE_LIMIT, len(window.image_files))):
+        window.current_index = i
+        window.new_tag_input.setText("bench")
+        step, _ = timed(window.add_tag)
+        samples.append(step)
+    flush_seconds, _ = timed(window.flush_tag_changes)
+    window.close()
+    return {'count': len(samples), 'seconds': sum(samples) + flush_seconds, 'samples': samples,
+            'flush_ms': flush_seconds * 1000}
+
+def bench_large_images(folder, db_path, workdir):
+    app, gui = start_gui(folder, workdir, db_path)
+    window, first_image, _ = open_window(app, gui, folder)
+    samples = [first_image]
+    for _ in range(len(window.image_files) - 1):
+        start = time.perf_counter()
+        window.show_next_image()
+        wait_for(app, image_shown(window))
+        samples.append(time.perf_counter() - start)
+    window.close()
+    return {'count': len(samples), 'seconds': sum(samples), 'samples': samples}
+
+def run_child(name, folder, db_path):
+    with tempfile.TemporaryDirectory(prefix="ilms-bench-") as workdir:
+        result = globals()["bench_" + name](folder, db_path, workdir)
+    samples = result.pop('samples', [])
+    if samples:
+        result['latency_ms'] = percentiles(samples)
+    if result.get('seconds'):
+        result['throughput'] = result['count'] / result['seconds']
+    result['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(result))
+    sys.stdout.flush()
+    os._exit(0)
+
+def run_benchmark(name, folder, db_path):
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name, folder, db_path],
+                             capture_output=True, text=True, env=env)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "子进程异常退出"}
+    return json.loads(lines[-1])
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r['name'], r['size']): r for r in json.load(f)['results']}
+    print(f"{'benchmark':<24}{'metric':<12}{'baseline':>12}{'current':>12}{'change':>10}")
+    for result in results:
+        old = baseline.get((result['name'], result['size']))
+        if old is None or 'error' in old or 'error' in result:
+            continue
+        metrics = [('seconds', old.get('seconds'), result.get('seconds'))]
+        if 'latency_ms' in old and 'latency_ms' in result:
+            metrics.append(('p50_ms', old['latency_ms']['p50'], result['latency_ms']['p50']))
+            metrics.append(('p99_ms', old['latency_ms']['p99'], result['latency_ms']['p99']))
+        metrics.append(('rss_mb', old.get('peak_rss_mb'), result.get('peak_rss_mb')))
+        for metric, before, after in metrics:
+            if before and after is not None:
+                label = f"{result['name']}/{result['size']}"
+                print(f"{label:<24}{metric:<12}{before:>12.4g}{after:>12.4g}{(after / before - 1) * 100:>+9.1f}%")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="image_label_bench", description="图片标签管理系统性能基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="小图片数据集的规模 (默认: 1000)")
+    parser.add_argument("--large", type=int, default=3, help="超大图片数量 (默认: 3，0 表示不测试)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="只运行这些基准测试")
+    parser.add_argument("--no-gui", action="store_true", help="跳过需要 PySide6 界面的基准测试")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "ilms-bench"),
+                        help="数据集缓存目录，重复运行时复用已生成的数据集")
+    parser.add_argument("-o", "--output", help="结果 JSON 文件路径")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--child"]:
+        run_child(*argv[1:4])
+    args = build_parser().parse_args(argv)
+    names = args.only or [name for name in BENCHMARKS if not (args.no_gui and name in GUI_BENCHMARKS)]
+    os.makedirs(args.workdir, exist_ok=True)
+
+    results = []
+    for size in args.sizes:
+        print(f"准备数据集: {size} 张小图片", file=sys.stderr)
+        folder = make_dataset(args.workdir, f"small-{size}", size, 160, 120)
+        db_path = make_database(folder)
+        for name in names:
+            if name == 'large_images':
+                continue
+            result = dict(name=name, size=size, **run_benchmark(name, folder, db_path))
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+    if args.large and 'large_images' in names:
+        print(f"准备数据集: {args.large} 张超大图片", file=sys.stderr)
+        folder = make_dataset(args.workdir, f"large-{args.large}", args.large, 10000, 7500)
+        result = dict(name='large_images', size=args.large,
+                      **run_benchmark('large_images', folder, make_database(folder)))
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from contextlib import nullcontext
+
+from image_label_core import (DUPLICATE_RADIUS, LEGACY_DB_NAME, MERGE_POLICIES, ORGANIZE_MODES, TAG_FORMATS,
+                              DatasetRegistry, DuplicateIndex, QueryCursor, TagDatabase, iter_image_files, organize_dataset,
+                              delete_files, rename_images, run_rename_batch, index_perceptual_hashes, identify_files, export_tags,
+                              import_tags, guess_tag_format, open_dataset, query_datasets, dataset_stats)
+
+REGISTER_BATCH_SIZE = 10000
+
+def read_paths(paths):
+    if paths == ['-'] or not paths:
+        for line in sys.stdin:
+            line = line.rstrip('\n')
+            if line:
+                yield os.path.abspath(line)
+    else:
+        for path in paths:
+            yield os.path.abspath(path)
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def print_progress(done, total):
+    print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+
+def cmd_scan(db, args):
+    folder = os.path.abspath(args.folder)
+    paths = list(iter_image_files(folder, args.recursive, db.organize_directories()))
+    for batch in chunks(paths, REGISTER_BATCH_SIZE):
+        db.register_images(batch)
+    identities = identify_files(paths, db.file_identities(folder), args.workers)
+    moved = len(db.reconcile(identities))
+    db.commit()
+    print(f"已扫描 {len(paths)} 张图片，{len(identities)} 张新增或已修改，{moved} 张移动过的图片已按内容匹配到新位置")
+
+def query_cursor(db, args):
+    try:
+        return QueryCursor(db, args.query, args.scope and os.path.abspath(args.scope))
+    except ValueError as e:
+        sys.exit(f"查询错误: {e}")
+
+def cmd_tag(db, args):
+    if args.query:
+        count = query_cursor(db, args).add_tag(args.tag)
+    else:
+        count = 0
+        for batch in chunks(args.paths, REGISTER_BATCH_SIZE):
+            count += db.add_tag_many(batch, args.tag)
+    db.commit()
+    print(f"已添加 {count} 个标签")
+
+def cmd_untag(db, args):
+    if args.query:
+        count = query_cursor(db, args).remove_tag(args.tag)
+    else:
+        count = 0
+        for batch in chunks(args.paths, REGISTER_BATCH_SIZE):
+            count += db.remove_tag_many(batch, args.tag)
+    db.commit()
+    print(f"已移除 {count} 个标签")
+
+def registered_datasets():
+    registry = DatasetRegistry()
+    try:
+        return registry.datasets()
+    finally:
+        registry.close()
+
+def cmd_query(db, args):
+    if args.all_datasets:
+        if not args.query:
+            sys.exit("--all-datasets 需要查询表达式")
+        try:
+            paths = query_datasets(registered_datasets(), args.query)
+            for path in paths:
+                print(path)
+        except ValueError as e:
+            sys.exit(f"查询错误: {e}")
+        return
+    if args.query:
+        paths = query_cursor(db, args)
+    elif args.untagged:
+        paths = db.iter_unlabeled_paths()
+    elif args.tag:
+        paths = db.iter_images_with_tag(args.tag)
+    else:
+        paths = db.iter_tagged_paths()
+    for path in paths:
+        print(path)
+
+def cmd_organize(db, args):
+    root = os.path.abspath(args.root)
+    if args.rebuild:
+        db.reset_organize_target(root)
+    organized, removed, failed, skipped = organize_dataset(db, root, args.mode, args.workers,
+                                                           progress=None if args.quiet else print_progress,
+                                                           radius=args.radius if args.skip_duplicates else None)
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(f"已整理 {organized} 张标记图片，移除已取消标签的图片 {removed} 张，失败 {failed} 张，跳过 {skipped} 张（相似图片、源文件缺失或同名文件）")
+
+def cmd_index_hashes(db, args):
+    try:
+        hashed, failed = index_perceptual_hashes(db, args.workers, progress=None if args.quiet else print_progress)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(f"已计算 {hashed} 张图片的感知哈希，无法读取 {failed} 张")
+
+def cmd_duplicates(db, args):
+    for distance, path in DuplicateIndex(db).near_duplicates(os.path.abspath(args.path), args.radius):
+        print(f"{distance}\t{path}")
+
+def open_labels(path, mode):
+    if path == '-':
+        return nullcontext(sys.stdout if mode == 'w' else sys.stdin)
+    return open(path, mode, encoding='utf-8', newline='')
+
+def label_format(args, path):
+    fmt = args.format or guess_tag_format(path)
+    if fmt is None:
+        sys.exit("无法从文件扩展名判断格式，请使用 --format 指定")
+    return fmt
+
+def cmd_export(db, args):
+    fmt = label_format(args, args.output)
+    root = args.relative_to and os.path.abspath(args.relative_to)
+    with open_labels(args.output, 'w') as file:
+        count = export_tags(db, file, fmt, root, args.scope and os.path.abspath(args.scope))
+    print(f"已导出 {count} 张图片的标签", file=sys.stderr if args.output == '-' else sys.stdout)
+
+def cmd_import(db, args):
+    fmt = label_format(args, args.input)
+    root = args.root and os.path.abspath(args.root)
+    with open_labels(args.input, 'r') as file:
+        try:
+            images, added, removed, skipped = import_tags(db, file, fmt, args.policy, root)
+        except KeyError as e:
+            sys.exit(f"导入失败: 缺少字段 {e}")
+        except (TypeError, ValueError, csv.Error) as e:
+            sys.exit(f"导入失败: {e}")
+    db.commit()
+    print(f"已导入 {images} 张图片的标签: 新增 {added} 个，移除 {removed} 个，跳过已有标签的图片 {skipped} 张")
+
+def cmd_rename(db, args):
+    batches = db.pending_rename_batches()
+    if args.resume or args.rollback:
+        if not batches:
+            print("没有未完成的批量重命名")
+            return
+        renamed = 0
+        for batch_id in batches:
+            try:
+                renamed += len(run_rename_batch(db, batch_id, rollback=args.rollback))
+            except OSError as e:
+                sys.exit(f"恢复批量重命名失败: {e}")
+        if args.rollback:
+            print(f"已回滚 {len(batches)} 个未完成的批量重命名")
+        else:
+            print(f"已继续完成 {len(batches)} 个批量重命名，共重命名 {renamed} 张图片")
+        return
+    if not args.prefix:
+        sys.exit("请指定前缀，或使用 --resume / --rollback 处理未完成的批量重命名")
+    if batches:
+        sys.exit("上次批量重命名未完成，请先使用 --resume 继续或 --rollback 回滚")
+    paths = sorted(iter_image_files(os.path.abspath(args.folder), args.recursive, db.organize_directories()))
+    renamed = rename_images(db, paths, args.prefix)
+    print(f"批量重命名完成，共重命名 {len(renamed)} 张图片")
+
+def cmd_delete_unlabeled(db, args):
+    exclude = db.organize_directories()
+    paths = [path for path in db.unlabeled_paths() if os.path.dirname(path) not in exclude]
+    progress = None if args.quiet else print_progress
+    if args.dry_run or not args.yes:
+        existing, total_bytes, _ = delete_files(paths, True, args.workers, progress=progress)
+        if not args.quiet:
+            print(file=sys.stderr)
+        print(f"未标记图片 {len(existing)} 张，共 {total_bytes / (1024 * 1024):.1f} MB")
+        if not args.dry_run:
+            print("使用 --yes 确认删除")
+        return
+    removed, total_bytes, failed = delete_files(paths, False, args.workers, progress=progress)
+    if not args.quiet:
+        print(file=sys.stderr)
+    db.delete_unlabeled(removed)
+    print(f"已删除 {len(removed)} 张未标记图片，释放 {total_bytes / (1024 * 1024):.1f} MB，失败 {failed} 张")
+
+def cmd_datasets(db, args):
+    registry = DatasetRegistry()
+    try:
+        if args.forget:
+            removed = registry.remove(os.path.abspath(args.forget))
+            print(f"已从数据集列表中移除 {removed} 个数据集")
+            return
+        for root, db_path in registry.datasets():
+            print(f"{root}\t{db_path}" + ("" if os.path.isfile(db_path) else "\t(数据库不存在)"))
+    finally:
+        registry.close()
+
+def cmd_stats(db, args):
+    stats = dataset_stats(registered_datasets()) if args.all_datasets else db.stats()
+    if args.json:
+        print(json.dumps(stats, ensure_ascii=False, indent=2))
+        return
+    if args.all_datasets:
+        print(f"数据集: {stats['datasets']}")
+    print(f"图片: {stats['images']}")
+    print(f"已标记: {stats['tagged']}")
+    print(f"未标记: {stats['unlabeled']}")
+    for tag, count in stats['tags'].items():
+        print(f"  {tag}: {count}")
+    if stats.get('pending_renames'):
+        print(f"未完成的批量重命名: {stats['pending_renames']} (使用 rename --resume 或 --rollback 处理)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="image_label_cli", description="图片标签管理系统命令行工具")
+    parser.add_argument("--dataset", help="数据集目录，默认按命令处理的文件夹、--scope 或图片路径查找，都没有时为当前目录")
+    parser.add_argument("--db", help="直接使用该数据库文件，不按数据集分库")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan = commands.add_parser("scan", help="扫描文件夹并登记图片")
+    scan.add_argument("folder")
+    scan.add_argument("-r", "--recursive", action="store_true", help="包含子文件夹")
+    scan.add_argument("--workers", type=int, default=8)
+    scan.set_defaults(func=cmd_scan, create=True)
+
+    for name, func, help_text in (("tag", cmd_tag, "为图片添加标签"), ("untag", cmd_untag, "移除图片的标签")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("tag")
+        command.add_argument("paths", nargs="*", help="图片路径，省略或为 - 时从标准输入逐行读取")
+        command.add_argument("--query", help="改为作用于匹配该查询表达式的所有图片")
+        command.add_argument("--scope", help="只作用于该文件夹下的图片")
+        command.set_defaults(func=func, create=True)
+
+    query = commands.add_parser("query", help="列出图片路径")
+    query.add_argument("query", nargs="?",
+                       help='标签查询表达式，如 "cat AND (indoor OR night) AND NOT blurry"，支持 tag* 前缀匹配')
+    query.add_argument("--scope", help="只列出该文件夹下的图片")
+    query.add_argument("--all-datasets", action="store_true", help="在所有已登记的数据集中查询")
+    group = query.add_mutually_exclusive_group()
+    group.add_argument("--tag", help="带有该标签的图片")
+    group.add_argument("--untagged", action="store_true", help="未标记的图片")
+    query.set_defaults(func=cmd_query)
+
+    organize_command = commands.add_parser("organize", help="按标签整理图片到文件夹")
+    organize_command.add_argument("root", help="标签文件夹所在目录")
+    organize_command.add_argument("--mode", choices=ORGANIZE_MODES, default="copy")
+    organize_command.add_argument("--workers", type=int, default=8)
+    organize_command.add_argument("-q", "--quiet", action="store_true")
+    organize_command.add_argument("--skip-duplicates", action="store_true",
+                                  help="同一标签文件夹中只放入一组相似图片中的第一张 (需先运行 index-hashes)")
+    organize_command.add_argument("--radius", type=int, default=DUPLICATE_RADIUS, help="相似图片的最大汉明距离")
+    organize_command.add_argument("--rebuild", action="store_true", help="忽略上次整理的记录，重新检查所有标记图片")
+    organize_command.set_defaults(func=cmd_organize)
+
+    export = commands.add_parser("export", help="导出标签到 CSV、JSONL 或 COCO 格式文件")
+    export.add_argument("output", help="输出文件，为 - 时写到标准输出")
+    export.add_argument("--format", choices=TAG_FORMATS, help="默认按扩展名判断 (.csv / .jsonl / .json)")
+    export.add_argument("--scope", help="只导出该文件夹下的图片")
+    export.add_argument("--relative-to", help="写入相对于该目录的路径")
+    export.set_defaults(func=cmd_export)
+
+    import_command = commands.add_parser("import", help="从 CSV、JSONL 或 COCO 格式文件导入标签")
+    import_command.add_argument("input", help="输入文件，为 - 时从标准输入读取")
+    import_command.add_argument("--format", choices=TAG_FORMATS, help="默认按扩展名判断 (.csv / .jsonl / .json)")
+    import_command.add_argument("--policy", choices=MERGE_POLICIES, default="union",
+                                help="union: 合并标签; overwrite: 以文件为准替换标签; skip: 跳过已有标签的图片")
+    import_command.add_argument("--root", help="文件中相对路径所基于的目录 (默认: 当前目录)")
+    import_command.set_defaults(func=cmd_import, create=True)
+
+    rename = commands.add_parser("rename", help="批量重命名文件夹中的图片")
+    rename.add_argument("folder")
+    rename.add_argument("prefix", nargs="?")
+    rename.add_argument("-r", "--recursive", action="store_true", help="包含子文件夹")
+    group = rename.add_mutually_exclusive_group()
+    group.add_argument("--resume", action="store_true", help="继续完成上次中断的批量重命名")
+    group.add_argument("--rollback", action="store_true", help="将上次中断的批量重命名回滚到原文件名")
+    rename.set_defaults(func=cmd_rename, create=True)
+
+    delete = commands.add_parser("delete-unlabeled", help="删除未标记的图片")
+    delete.add_argument("--dry-run", action="store_true", help="只统计，不删除")
+    delete.add_argument("-y", "--yes", action="store_true", help="确认删除")
+    delete.add_argument("--workers", type=int, default=8)
+    delete.add_argument("-q", "--quiet", action="store_true")
+    delete.set_defaults(func=cmd_delete_unlabeled)
+
+    index_hashes = commands.add_parser("index-hashes", help="为已登记但尚未计算的图片计算感知哈希")
+    index_hashes.add_argument("--workers", type=int, help="进程数 (默认: CPU 核数)")
+    index_hashes.add_argument("-q", "--quiet", action="store_true")
+    index_hashes.set_defaults(func=cmd_index_hashes)
+
+    duplicates = commands.add_parser("duplicates", help="列出与指定图片相似的图片")
+    duplicates.add_argument("path")
+    duplicates.add_argument("--radius", type=int, default=DUPLICATE_RADIUS, help="最大汉明距离")
+    duplicates.set_defaults(func=cmd_duplicates)
+
+    stats = commands.add_parser("stats", help="显示数据库统计信息")
+    stats.add_argument("--json", action="store_true")
+    stats.add_argument("--all-datasets", action="store_true", help="汇总所有已登记的数据集")
+    stats.set_defaults(func=cmd_stats)
+
+    datasets = commands.add_parser("datasets", help="列出已登记的数据集")
+    datasets.add_argument("--forget", metavar="ROOT", help="从列表中移除该数据集 (不删除数据库文件)")
+    datasets.set_defaults(func=cmd_datasets)
+    return parser
+
+def dataset_folder(args):
+    if args.dataset:
+        return args.dataset
+    if getattr(args, "folder", None):
+        return args.folder
+    if getattr(args, "scope", None):
+        return args.scope
+    if getattr(args, "path", None):
+        return os.path.dirname(os.path.abspath(args.path))
+    if getattr(args, "paths", None):
+        return os.path.commonpath([os.path.dirname(path) for path in args.paths])
+    if args.func is cmd_import and args.root:
+        return args.root
+    return os.getcwd()
+
+def open_database(args):
+    if args.db:
+        return TagDatabase(args.db)
+    return open_dataset(dataset_folder(args), legacy_db=LEGACY_DB_NAME, create=getattr(args, "create", False))
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.func is cmd_datasets or getattr(args, "all_datasets", False):
+        args.func(None, args)
+        return
+    if args.func in (cmd_tag, cmd_untag) and not args.query:
+        args.paths = list(read_paths(args.paths))
+    try:
+        db = open_database(args)
+    except ValueError as e:
+        sys.exit(str(e))
+    try:
+        args.func(db, args)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2258 @@
+import bisect
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+class Profiler:
+    def __init__(self, history=200, max_events=200000):
+        self.enabled = False
+        self.history = history
+        self.timings = {}
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+
+    def span(self, name):
+        return Span(self, name) if self.enabled else NULL_SPAN
+
+    def record(self, name, start, duration):
+        if not self.enabled:
+            return
+        samples = self.timings.get(name)
+        if samples is None:
+            samples = self.timings.setdefault(name, deque(maxlen=self.history))
+        samples.append(duration)
+        self.events.append((name, start, duration, threading.get_ident()))
+
+    def clear(self):
+        self.timings.clear()
+        self.events.clear()
+
+    def summary(self):
+        result = {}
+        for name, samples in list(self.timings.items()):
+            ordered = sorted(samples)
+            if ordered:
+                result[name] = (samples[-1], ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))])
+        return result
+
+    def dump(self, path):
+        import json
+        events = list(self.events)
+        pid = os.getpid()
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                for name, start, duration, thread in events:
+                    f.write(json.dumps({'name': name, 'start': start - self.origin,
+                                        'duration_ms': duration * 1000, 'thread': thread}, ensure_ascii=False))
+                    f.write("\n")
+            else:
+                json.dump({'traceEvents': [
+                    {'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+                     'pid': pid, 'tid': thread}
+                    for name, start, duration, thread in events
+                ]}, f, ensure_ascii=False)
+        return len(events)
+
+PROFILER = Profiler()
+
+def iter_image_files(folder, recursive=False, exclude=()):
+    pending = [folder]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        if entry.is_file():
+                            yield entry.path
+                    elif (recursive and not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False)
+                          and os.path.abspath(entry.path) not in exclude):
+                        pending.append(entry.path)
+        except OSError:
+            continue
+
+SNAPSHOT_RACY_NS = 2 * 10 ** 9
+
+def encode_names(names):
+    return '\0'.join(names).encode('utf-8', 'surrogateescape')
+
+def decode_names(blob):
+    return bytes(blob).decode('utf-8', 'surrogateescape').split('\0') if blob else []
+
+def list_directory(directory):
+    mtime_ns = os.stat(directory).st_mtime_ns
+    files, subdirectories = [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                if entry.is_file():
+                    files.append(entry.name)
+            elif not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.name)
+    if time.time_ns() - mtime_ns < SNAPSHOT_RACY_NS:
+        mtime_ns = None
+    return mtime_ns, files, subdirectories
+
+def scan_folder(folder, recursive=False, snapshot=None, exclude=()):
+    snapshot = snapshot or {}
+    pending = [folder]
+    while pending:
+        directory = pending.pop()
+        cached = snapshot.get(directory)
+        try:
+            if cached is not None and cached[0] is not None and cached[0] == os.stat(directory).st_mtime_ns:
+                mtime_ns, files, subdirectories = cached
+                added, changed = (), False
+            else:
+                mtime_ns, files, subdirectories = list_directory(directory)
+                known = set(cached[1]) if cached is not None else ()
+                added, changed = [name for name in files if name not in known], True
+        except OSError:
+            continue
+        yield directory, mtime_ns, files, subdirectories, added, changed
+        if recursive:
+            subdirectories = (os.path.join(directory, name) for name in reversed(subdirectories))
+            pending.extend(path for path in subdirectories if os.path.abspath(path) not in exclude)
+
+def diff_directories(directories, known, recursive=False, watched=(), exclude=()):
+    added, removed, new_directories = [], [], []
+    targets = {directory: set() for directory in directories}
+    for path in known:
+        existing = targets.get(os.path.dirname(path))
+        if existing is not None:
+            existing.add(path)
+    for directory, existing in targets.items():
+        if not os.path.isdir(directory):
+            prefix = directory.rstrip('/\\') + os.sep
+            removed.extend(path for path in known if path.startswith(prefix))
+            continue
+        current = set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        if entry.is_file():
+                            current.add(entry.path)
+                    elif (recursive and not entry.name.startswith('.') and entry.path not in watched
+                          and entry.is_dir(follow_symlinks=False) and os.path.abspath(entry.path) not in exclude):
+                        files = [path for path in iter_image_files(entry.path, True, exclude) if path not in known]
+                        added.extend(sorted(files))
+                        new_directories.append(entry.path)
+                        new_directories.extend({os.path.dirname(path) for path in files} - {entry.path})
+        except OSError:
+            continue
+        added.extend(sorted(current - existing))
+        removed.extend(existing - current)
+    return added, removed, new_directories
+
+class FileIndex:
+    EMPTY = 0
+    DELETED = 0xFFFFFFFF
+
+    def __init__(self, paths=()):
+        self.clear()
+        self.extend(paths)
+
+    def clear(self):
+        self.directories = []
+        self.directory_ids = {}
+        self.names = bytearray()
+        self.offsets = array('Q')
+        self.lengths = array('H')
+        self.parents = array('I')
+        self.garbage = 0
+        self.slots = None
+        self.filled = 0
+
+    def copy(self):
+        other = FileIndex.__new__(FileIndex)
+        other.directories = list(self.directories)
+        other.directory_ids = dict(self.directory_ids)
+        other.names = bytearray(self.names)
+        other.offsets = array('Q', self.offsets)
+        other.lengths = array('H', self.lengths)
+        other.parents = array('I', self.parents)
+        other.garbage = self.garbage
+        other.slots = self.slots and array('I', self.slots)
+        other.filled = self.filled
+        return other
+
+    def _parent(self, prefix):
+        parent = self.directory_ids.get(prefix)
+        if parent is None:
+            parent = self.directory_ids[prefix] = len(self.directories)
+            self.directories.append(prefix)
+        return parent
+
+    def _name(self, row):
+        start = self.offsets[row]
+        return bytes(self.names[start:start + self.lengths[row]])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        start = self.offsets[row]
+        name = self.names[start:start + self.lengths[row]].decode('utf-8', 'surrogateescape')
+        return self.directories[self.parents[row]] + name
+
+    def __iter__(self):
+        directories, names = self.directories, self.names
+        for start, length, parent in zip(self.offsets, self.lengths, self.parents):
+            yield directories[parent] + names[start:start + length].decode('utf-8', 'surrogateescape')
+
+    def __contains__(self, path):
+        return self.index_of(path) is not None
+
+    def append(self, path):
+        self.extend((path,))
+
+    def extend(self, paths):
+        first = len(self)
+        names, offsets, lengths, parents = self.names, self.offsets, self.lengths, self.parents
+        basename = os.path.basename
+        last_prefix = last_parent = None
+        for path in paths:
+            name = basename(path)
+            prefix = path[:len(path) - len(name)]
+            if prefix != last_prefix:
+                last_prefix, last_parent = prefix, self._parent(prefix)
+            name = name.encode('utf-8', 'surrogateescape')
+            offsets.append(len(names))
+            lengths.append(len(name))
+            parents.append(last_parent)
+            names += name
+        if self.slots is not None:
+            for row in range(first, len(self)):
+                self._insert_slot(row)
+
+    def __setitem__(self, row, path):
+        if row < 0:
+            row += len(self)
+        if self.slots is not None:
+            self._delete_slot(row)
+        name = os.path.basename(path)
+        parent = self._parent(path[:len(path) - len(name)])
+        name = name.encode('utf-8', 'surrogateescape')
+        length = self.lengths[row]
+        if len(name) <= length:
+            start = self.offsets[row]
+            self.names[start:start + len(name)] = name
+            self.garbage += length - len(name)
+        else:
+            self.offsets[row] = len(self.names)
+            self.names += name
+            self.garbage += length
+        self.lengths[row] = len(name)
+        self.parents[row] = parent
+        if self.slots is not None:
+            self._insert_slot(row)
+        if self.garbage > len(self.names) // 2:
+            self._compact_names()
+
+    def remove(self, paths):
+        rows = sorted({row for row in map(self.index_of, paths) if row is not None})
+        if not rows:
+            return rows
+        offsets, lengths, parents = array('Q'), array('H'), array('I')
+        start = 0
+        for row in rows + [len(self)]:
+            offsets += self.offsets[start:row]
+            lengths += self.lengths[start:row]
+            parents += self.parents[start:row]
+            start = row + 1
+        self.garbage += sum(self.lengths[row] for row in rows)
+        self.offsets, self.lengths, self.parents = offsets, lengths, parents
+        self.slots = None
+        if self.garbage > len(self.names) // 2:
+            self._compact_names()
+        return rows
+
+    def _compact_names(self):
+        names, offsets = bytearray(), array('Q')
+        for start, length in zip(self.offsets, self.lengths):
+            offsets.append(len(names))
+            names += self.names[start:start + length]
+        self.names, self.offsets = names, offsets
+        self.garbage = 0
+
+    def _build_slots(self):
+        size = 8
+        while size < 2 * len(self) + 2:
+            size *= 2
+        mask = size - 1
+        slots = array('I', bytes(4 * size))
+        names = bytes(self.names)
+        for row, (start, length, parent) in enumerate(zip(self.offsets, self.lengths, self.parents), 1):
+            slot = hash((parent, names[start:start + length])) & mask
+            while slots[slot]:
+                slot = (slot + 1) & mask
+            slots[slot] = row
+        self.slots, self.filled = slots, len(self)
+
+    def _insert_slot(self, row):
+        if 2 * (self.filled + 1) > len(self.slots):
+            self._build_slots()
+            return
+        mask = len(self.slots) - 1
+        slot = hash((self.parents[row], self._name(row))) & mask
+        while self.slots[slot] != self.EMPTY:
+            slot = (slot + 1) & mask
+        self.slots[slot] = row + 1
+        self.filled += 1
+
+    def _delete_slot(self, row):
+        mask = len(self.slots) - 1
+        slot = hash((self.parents[row], self._name(row))) & mask
+        while self.slots[slot] != row + 1:
+            slot = (slot + 1) & mask
+        self.slots[slot] = self.DELETED
+
+    def index_of(self, path):
+        name = os.path.basename(path)
+        parent = self.directory_ids.get(path[:len(path) - len(name)])
+        if parent is None:
+            return None
+        if self.slots is None:
+            self._build_slots()
+        name = name.encode('utf-8', 'surrogateescape')
+        slots, mask = self.slots, len(self.slots) - 1
+        slot = hash((parent, name)) & mask
+        while True:
+            value = slots[slot]
+            if value == self.EMPTY:
+                return None
+            if value != self.DELETED and self.parents[value - 1] == parent and self._name(value - 1) == name:
+                return value - 1
+            slot = (slot + 1) & mask
+
+ORGANIZE_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        cloned = False
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                cloned = True
+            except OSError:
+                pass
+        if not cloned and hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                cloned = remaining == 0
+            except OSError:
+                pass
+        if not cloned:
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dst)
+
+def place_file(src, dst, mode='copy'):
+    if mode == 'hardlink':
+        os.link(src, dst)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'reflink':
+        reflink_file(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+def same_file(src, dst):
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        size = os.stat(src).st_size
+        return size == os.stat(dst).st_size and sampled_hash(src, size) == sampled_hash(dst, size)
+    except OSError:
+        return False
+
+def iter_parallel(func, items, max_workers=8, cancelled=None, processes=False):
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+    if processes:
+        import multiprocessing
+        executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers)
+    with executor:
+        running = {}
+        pending = iter(items)
+        while True:
+            while len(running) < max_workers * 4 and not (cancelled and cancelled()):
+                item = next(pending, None)
+                if item is None:
+                    break
+                running[executor.submit(func, item)] = item
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = running.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+
+SAMPLE_SIZE = 64 * 1024
+
+def sampled_hash(path, size):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= SAMPLE_SIZE * 3:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                f.seek(offset)
+                digest.update(f.read(SAMPLE_SIZE))
+    return f"{size:x}-{digest.hexdigest()}"
+
+def full_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def identify_file(path, known=None):
+    stat = os.stat(path)
+    if known is not None and known[:3] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+        return None
+    return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size, sampled_hash(path, stat.st_size), None)
+
+def identify_files(paths, known, max_workers=8, cancelled=None):
+    changed = {}
+    keys = {}
+    for path, identity, error in iter_parallel(lambda path: identify_file(path, known.get(path)),
+                                               paths, max_workers, cancelled):
+        if error is not None:
+            continue
+        if identity is not None:
+            changed[path] = identity
+            keys.setdefault(identity[4], []).append(path)
+        else:
+            keys.setdefault(known[path][3], []).append(path)
+    for key, group in keys.items():
+        if len(group) < 2 or (cancelled and cancelled()):
+            continue
+        for path in group:
+            identity = changed.get(path) or (path, *known[path])
+            if identity[5] is None:
+                try:
+                    changed[path] = identity[:5] + (full_hash(path),)
+                except OSError:
+                    continue
+    return list(changed.values())
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+def remove_file(path):
+    try:
+        size = os.stat(path).st_size
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+def throttled(callback, interval=0.05):
+    last_call = [0.0]
+
+    def report(done, total):
+        now = time.monotonic()
+        if done == total or now - last_call[0] >= interval:
+            last_call[0] = now
+            callback(done, total)
+    return report
+
+def organize_dataset(db, root, mode='copy', max_workers=8, cancelled=None, progress=None, radius=None):
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        db.reset_organize_target(root)
+    target_id, since = db.organize_target(root)
+    missing = [tag_id for tag_id, tag in db.organized_tags(target_id) if not os.path.isdir(os.path.join(root, tag))]
+    if missing:
+        db.forget_organized_tags(target_id, missing)
+        since = None
+    until = db.change_seq()
+    links, unlinks = [], []
+    planned = set()
+    trees = {}
+    directories = {}
+    skipped = 0
+    for image_id, tag_id, path, tag, value, dest in db.organize_changes(target_id, since, until):
+        new_dest = path and os.path.join(root, tag, os.path.basename(path))
+        if new_dest == dest:
+            continue
+        if dest is not None:
+            unlinks.append((image_id, tag_id, dest))
+        if new_dest is None or new_dest in planned:
+            continue
+        if radius is not None and value is not None and dest is None:
+            tree = trees.get(tag_id)
+            if tree is None:
+                tree = trees[tag_id] = BKTree()
+                for placed_value in db.organized_hashes(target_id, tag_id):
+                    tree.add(placed_value, None)
+            if tree.search(value, radius):
+                skipped += 1
+                continue
+            tree.add(value, path)
+        planned.add(new_dest)
+        directories[os.path.dirname(new_dest)] = None
+        links.append((image_id, tag_id, path, new_dest))
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    def unlink(operation):
+        try:
+            os.remove(operation[2])
+        except FileNotFoundError:
+            pass
+
+    def link(operation):
+        if not os.path.exists(operation[2]):
+            return None
+        if os.path.lexists(operation[3]):
+            return False if same_file(operation[2], operation[3]) else None
+        place_file(operation[2], operation[3], mode)
+        return True
+
+    total = len(unlinks) + len(links)
+    done = failed = organized = 0
+    placed, removed = [], []
+    report = throttled(progress) if progress else None
+    if report:
+        report(0, total)
+    for operation, _, error in iter_parallel(unlink, unlinks, max_workers, cancelled):
+        done += 1
+        if error is None:
+            removed.append(operation[:2])
+        else:
+            failed += 1
+        if report:
+            report(done, total)
+    for operation, created, error in iter_parallel(link, links, max_workers, cancelled):
+        done += 1
+        if error is not None:
+            failed += 1
+        elif created is None:
+            skipped += 1
+        else:
+            organized += created
+            placed.append((operation[0], operation[1], operation[3]))
+        if report:
+            report(done, total)
+    complete = not failed and done == total
+    db.record_organized(target_id, placed, removed, until if complete else None)
+    return organized, len(removed), failed, skipped
+
+def delete_files(paths, dry_run=False, max_workers=8, cancelled=None, progress=None):
+    total = len(paths)
+    done = failed = total_bytes = 0
+    removed = []
+    report = throttled(progress) if progress else None
+    if report:
+        report(0, total)
+    for path, size, error in iter_parallel(file_size if dry_run else remove_file,
+                                           paths, max_workers, cancelled):
+        done += 1
+        if error is not None:
+            failed += 1
+        else:
+            removed.append(path)
+            total_bytes += size or 0
+        if report:
+            report(done, total)
+    return removed, total_bytes, failed
+
+def plan_rename(paths, prefix):
+    sources = {os.path.normcase(path) for path in paths}
+    taken = {}
+    mapping = []
+    number = 0
+    for old_path in paths:
+        directory, old_name = os.path.split(old_path)
+        occupied = taken.get(directory)
+        if occupied is None:
+            try:
+                with os.scandir(directory) as entries:
+                    occupied = {
+                        os.path.normcase(entry.name) for entry in entries
+                        if os.path.normcase(entry.path) not in sources
+                    }
+            except OSError:
+                occupied = set()
+            taken[directory] = occupied
+        ext = os.path.splitext(old_name)[1]
+        while True:
+            number += 1
+            new_name = f"{prefix}_{number:04d}{ext}"
+            if os.path.normcase(new_name) not in occupied:
+                break
+        occupied.add(os.path.normcase(new_name))
+        if new_name != old_name:
+            mapping.append((old_path, os.path.join(directory, new_name)))
+    return mapping
+
+def run_rename_batch(db, batch_id, rollback=False, cancelled=None, progress=None):
+    phase, entries = db.rename_batch(batch_id)
+    if rollback:
+        if phase == 1:
+            for old_path, tmp_path, new_path in entries:
+                if not os.path.lexists(tmp_path) and os.path.lexists(new_path):
+                    os.rename(new_path, tmp_path)
+        for old_path, tmp_path, new_path in entries:
+            if os.path.lexists(tmp_path):
+                os.rename(tmp_path, old_path)
+        db.discard_rename_batch(batch_id)
+        return []
+    
+    total = 2 * len(entries)
+    report = throttled(progress) if progress else None
+    if phase == 0:
+        for done, (old_path, tmp_path, new_path) in enumerate(entries, 1):
+            if cancelled and cancelled():
+                return run_rename_batch(db, batch_id, rollback=True)
+            if not os.path.lexists(tmp_path) and os.path.lexists(old_path):
+                os.rename(old_path, tmp_path)
+            if report:
+                report(done, total)
+        db.set_rename_phase(batch_id, 1)
+    renamed = []
+    for done, (old_path, tmp_path, new_path) in enumerate(entries, len(entries) + 1):
+        if os.path.lexists(tmp_path):
+            os.rename(tmp_path, new_path)
+        if os.path.lexists(new_path):
+            renamed.append((old_path, tmp_path, new_path))
+        if report:
+            report(done, total)
+    db.finish_rename_batch(batch_id, renamed)
+    return [(old_path, new_path) for old_path, _, new_path in renamed]
+
+def rename_images(db, paths, prefix, cancelled=None, progress=None):
+    batch_id = db.create_rename_batch(plan_rename(paths, prefix))
+    try:
+        return run_rename_batch(db, batch_id, cancelled=cancelled, progress=progress)
+    except OSError:
+        try:
+            run_rename_batch(db, batch_id, rollback=True)
+        except OSError:
+            pass
+        raise
+
+def register_folder(db, paths, cancelled=None, progress=None, chunk_size=10000):
+    total = len(paths)
+    report = throttled(progress) if progress else None
+
+    def iter_paths():
+        for start in range(0, total, chunk_size):
+            if cancelled is not None and cancelled():
+                return
+            if report:
+                report(start, total)
+            yield from paths[start:start + chunk_size]
+        if report:
+            report(total, total)
+    count = db.register_images(iter_paths())
+    db.commit()
+    return count
+
+EXIF_SCAN_BYTES = 128 * 1024
+
+def read_exif_thumbnail(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(EXIF_SCAN_BYTES)
+    except OSError:
+        return None
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker in (0xD9, 0xDA):
+            break
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\0\0':
+            return exif_thumbnail(data[pos + 10:pos + 2 + length])
+        pos += 2 + length
+    return None
+
+def exif_thumbnail(tiff):
+    byteorder = {b'II': 'little', b'MM': 'big'}.get(tiff[:2])
+    if byteorder is None:
+        return None
+
+    def number(offset, size):
+        return int.from_bytes(tiff[offset:offset + size], byteorder)
+    ifd0 = number(4, 4)
+    ifd1 = number(ifd0 + 2 + 12 * number(ifd0, 2), 4)
+    if not ifd1 or ifd1 + 2 > len(tiff):
+        return None
+    start = length = 0
+    for i in range(number(ifd1, 2)):
+        entry = ifd1 + 2 + 12 * i
+        tag = number(entry, 2)
+        if tag == 0x0201:
+            start = number(entry + 8, 4)
+        elif tag == 0x0202:
+            length = number(entry + 8, 4)
+    thumbnail = tiff[start:start + length] if start and length else b''
+    return thumbnail if thumbnail[:2] == b'\xff\xd8' else None
+
+HASH_SIZE = 8
+DUPLICATE_RADIUS = 6
+
+def read_grayscale_pillow(path, width, height):
+    import numpy
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(path) as image:
+            image.draft('L', (width, height))
+            image = ImageOps.exif_transpose(image).convert('L').resize((width, height), Image.BILINEAR)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return numpy.asarray(image)
+
+def read_grayscale_qt(path, width, height):
+    import numpy
+    from PySide6.QtCore import QSize
+    from PySide6.QtGui import QImage, QImageReader
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    reader.setScaledSize(QSize(width, height))
+    image = reader.read()
+    if image.isNull():
+        return None
+    image = image.convertToFormat(QImage.Format_Grayscale8)
+    return numpy.frombuffer(image.constBits(), numpy.uint8).reshape(height, image.bytesPerLine())[:, :width].copy()
+
+def grayscale_reader():
+    from importlib.util import find_spec
+    if find_spec('PIL') is not None:
+        return read_grayscale_pillow
+    if find_spec('PySide6') is not None:
+        return read_grayscale_qt
+    return None
+
+def compute_dhashes(paths):
+    import numpy
+    read = grayscale_reader()
+    width, height = (HASH_SIZE + 1) * 4, HASH_SIZE * 4
+    pixels = numpy.zeros((len(paths), height, width), numpy.float32)
+    decoded = []
+    for path in paths:
+        rows = read(path, width, height)
+        if rows is None:
+            continue
+        pixels[len(decoded)] = rows
+        decoded.append(path)
+    blocks = pixels[:len(decoded)].reshape(len(decoded), HASH_SIZE, 4, HASH_SIZE + 1, 4).mean(axis=(2, 4))
+    bits = numpy.packbits(blocks[:, :, 1:] > blocks[:, :, :-1], axis=-1)
+    values = bits.reshape(len(decoded), 8).view('>u8').ravel()
+    return [(path, int(value)) for path, value in zip(decoded, values)]
+
+def hash_images(paths, max_workers=None, cancelled=None, chunk_size=64):
+    from importlib.util import find_spec
+    if find_spec('numpy') is None:
+        raise RuntimeError("计算感知哈希需要安装 numpy")
+    if grayscale_reader() is None:
+        raise RuntimeError("计算感知哈希需要安装 Pillow 或 PySide6 以解码图片")
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    for chunk, hashes, error in iter_parallel(compute_dhashes, chunks, max_workers or os.cpu_count() or 1,
+                                              cancelled, processes=True):
+        yield chunk, [] if error else hashes
+
+def index_perceptual_hashes(db, max_workers=None, cancelled=None, progress=None):
+    paths = db.unhashed_paths()
+    total = len(paths)
+    done = hashed = 0
+    report = throttled(progress) if progress else None
+    if report:
+        report(0, total)
+    for chunk, hashes in hash_images(paths, max_workers, cancelled):
+        db.set_perceptual_hashes(hashes)
+        done += len(chunk)
+        hashed += len(hashes)
+        if report:
+            report(done, total)
+    db.commit()
+    return hashed, done - hashed
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, radius):
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= radius:
+                results.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(results)
+
+class DuplicateIndex:
+    def __init__(self, db):
+        self.hashes = dict(db.iter_perceptual_hashes())
+        self.tree = BKTree()
+        for path, value in self.hashes.items():
+            self.tree.add(value, path)
+
+    def near_duplicates(self, path, radius=DUPLICATE_RADIUS):
+        value = self.hashes.get(path)
+        if value is None:
+            return []
+        return [(distance, other) for distance, other in self.tree.search(value, radius) if other != path]
+
+SCHEMA_VERSION = 7
+
+IMAGE_COLUMNS = (('phash', 'INTEGER'), ('inode', 'INTEGER'), ('mtime_ns', 'INTEGER'), ('size', 'INTEGER'),
+                 ('content_key', 'TEXT'), ('full_hash', 'TEXT'))
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        path TEXT NOT NULL UNIQUE,
+        tag_count INTEGER NOT NULL DEFAULT 0,
+        phash INTEGER,
+        inode INTEGER,
+        mtime_ns INTEGER,
+        size INTEGER,
+        content_key TEXT,
+        full_hash TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_images_tag_count ON images (tag_count);
+    CREATE INDEX IF NOT EXISTS idx_images_phash ON images (phash);
+    CREATE INDEX IF NOT EXISTS idx_images_content_key ON images (content_key);
+    CREATE TABLE IF NOT EXISTS tags (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS image_tags (
+        image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+        tag_id INTEGER NOT NULL REFERENCES tags (id) ON DELETE CASCADE,
+        PRIMARY KEY (image_id, tag_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag_id, image_id);
+    CREATE TRIGGER IF NOT EXISTS trg_image_tags_insert AFTER INSERT ON image_tags BEGIN
+        UPDATE images SET tag_count = tag_count + 1 WHERE id = NEW.image_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_image_tags_delete AFTER DELETE ON image_tags BEGIN
+        UPDATE images SET tag_count = tag_count - 1 WHERE id = OLD.image_id;
+    END;
+    CREATE TABLE IF NOT EXISTS rename_batches (
+        id INTEGER PRIMARY KEY,
+        phase INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS rename_journal (
+        batch_id INTEGER NOT NULL REFERENCES rename_batches (id) ON DELETE CASCADE,
+        seq INTEGER NOT NULL,
+        old_path TEXT NOT NULL,
+        tmp_path TEXT NOT NULL,
+        new_path TEXT NOT NULL,
+        PRIMARY KEY (batch_id, seq)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS organize_targets (
+        id INTEGER PRIMARY KEY,
+        root TEXT NOT NULL UNIQUE,
+        change_seq INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS organize_manifest (
+        target_id INTEGER NOT NULL REFERENCES organize_targets (id) ON DELETE CASCADE,
+        image_id INTEGER NOT NULL,
+        tag_id INTEGER NOT NULL,
+        dest TEXT NOT NULL,
+        PRIMARY KEY (target_id, image_id, tag_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_organize_manifest_tag ON organize_manifest (target_id, tag_id);
+    CREATE TABLE IF NOT EXISTS scan_snapshots (
+        directory TEXT PRIMARY KEY,
+        mtime_ns INTEGER,
+        files BLOB NOT NULL,
+        subdirectories BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS tag_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_id INTEGER NOT NULL,
+        tag_id INTEGER NOT NULL
+    );
+    CREATE TRIGGER IF NOT EXISTS trg_tag_changes_insert AFTER INSERT ON image_tags
+    WHEN EXISTS (SELECT 1 FROM organize_targets) BEGIN
+        INSERT INTO tag_changes (image_id, tag_id) VALUES (NEW.image_id, NEW.tag_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tag_changes_delete AFTER DELETE ON image_tags
+    WHEN EXISTS (SELECT 1 FROM organize_targets) BEGIN
+        INSERT INTO tag_changes (image_id, tag_id) VALUES (OLD.image_id, OLD.tag_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tag_changes_path AFTER UPDATE OF path ON images
+    WHEN NEW.tag_count > 0 AND EXISTS (SELECT 1 FROM organize_targets) BEGIN
+        INSERT INTO tag_changes (image_id, tag_id) SELECT NEW.id, tag_id FROM image_tags WHERE image_id = NEW.id;
+    END;
+'''
+
+class TagDatabase:
+    def __init__(self, path, cache_mb=64, root=None):
+        self.path = path
+        self.cache_mb = cache_mb
+        self.root = root and os.path.abspath(root)
+        self.prefix = self.root and os.path.join(self.root, '')
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(f"PRAGMA cache_size = -{cache_mb * 1024}")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.pending = {}
+        self.tag_cache = None
+        self.migrate()
+
+    def migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(images)")]
+        legacy = 'tags' in columns
+        self.conn.execute("BEGIN")
+        try:
+            if legacy:
+                self.conn.execute("ALTER TABLE images RENAME TO images_v1")
+            elif columns:
+                for name, column_type in IMAGE_COLUMNS:
+                    if name not in columns:
+                        self.conn.execute(f"ALTER TABLE images ADD COLUMN {name} {column_type}")
+            for statement in self._split_schema():
+                self.conn.execute(statement)
+            if legacy:
+                self._migrate_v1()
+                self.conn.execute("DROP TABLE images_v1")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    @staticmethod
+    def _split_schema():
+        statements, current = [], ""
+        for line in SCHEMA.strip().splitlines():
+            current += line + "\n"
+            if sqlite3.complete_statement(current):
+                statements.append(current.strip())
+                current = ""
+        return statements
+
+    def _migrate_v1(self):
+        self.conn.execute(
+            "INSERT INTO images (id, path) SELECT id, path FROM images_v1 WHERE path IS NOT NULL"
+        )
+        tag_ids = {}
+        pairs = []
+        rows = self.conn.execute(
+            "SELECT id, tags FROM images_v1 WHERE path IS NOT NULL AND tags IS NOT NULL AND tags != ''"
+        )
+        for image_id, tags in rows.fetchall():
+            for tag in tags.split(','):
+                if not tag:
+                    continue
+                if tag not in tag_ids:
+                    tag_ids[tag] = self._tag_id(tag)
+                pairs.append((image_id, tag_ids[tag]))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO image_tags (image_id, tag_id) VALUES (?, ?)", pairs
+        )
+
+    def _key(self, path):
+        if self.root is None:
+            return path
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):]
+        return '' if path == self.root else path
+
+    def _path(self, key):
+        return key if self.root is None else os.path.join(self.root, key)
+
+    def reopen(self):
+        return TagDatabase(self.path, self.cache_mb, self.root)
+
+    def _tag_id(self, tag):
+        self.conn.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+        return self.conn.execute("SELECT id FROM tags WHERE name = ?", (tag,)).fetchone()[0]
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def has_pending(self):
+        return bool(self.pending)
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        added, removed = [], []
+        for path, changes in self.pending.items():
+            key = self._key(path)
+            for tag, add in changes.items():
+                (added if add else removed).append((key, tag))
+        try:
+            self._write_pending(added, removed)
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.pending = {}
+        return len(added) + len(removed)
+
+    def _write_pending(self, added, removed):
+        if added:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tags (name) VALUES (?)", ((tag,) for tag in {t for _, t in added})
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO images (path) VALUES (?)", ((path,) for path in {p for p, _ in added})
+            )
+            self.conn.executemany('''
+                INSERT OR IGNORE INTO image_tags (image_id, tag_id)
+                SELECT images.id, tags.id FROM images, tags
+                WHERE images.path = ? AND tags.name = ?
+            ''', added)
+        if removed:
+            self.conn.executemany('''
+                DELETE FROM image_tags
+                WHERE image_id = (SELECT id FROM images WHERE path = ?)
+                  AND tag_id = (SELECT id FROM tags WHERE name = ?)
+            ''', removed)
+        self.conn.commit()
+
+    def rename_pending(self, mapping):
+        self.pending = {mapping.get(path, path): changes for path, changes in self.pending.items()}
+        self._rename_cached(mapping.items())
+
+    def load_tags(self):
+        self.tag_cache = None
+        names = {}
+        self.tag_cache = {path: [names.setdefault(tag, tag) for tag in tags]
+                          for path, tags in self.iter_image_tags()}
+        return len(self.tag_cache)
+
+    def _cache_tag(self, path, tag, add):
+        if self.tag_cache is None:
+            return
+        tags = self.tag_cache.get(path)
+        if add:
+            if tags is None:
+                self.tag_cache[path] = [tag]
+            elif tag not in tags:
+                tags.append(tag)
+        elif tags is not None and tag in tags:
+            tags.remove(tag)
+            if not tags:
+                del self.tag_cache[path]
+
+    def _rename_cached(self, moves):
+        if self.tag_cache is None:
+            return
+        moved = [(new_path, self.tag_cache.pop(old_path, None)) for old_path, new_path in moves]
+        for new_path, tags in moved:
+            if tags is not None:
+                self.tag_cache[new_path] = tags
+
+    def _queue(self, path, tag, add):
+        changes = self.pending.setdefault(path, {})
+        changes.pop(tag, None)
+        changes[tag] = add
+        self._cache_tag(path, tag, add)
+
+    def register_images(self, paths):
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO images (path) VALUES (?)", ((self._key(path),) for path in paths)
+        )
+        return cursor.rowcount
+
+    def add_tag_many(self, paths, tag):
+        self.flush()
+        tag_id = self._tag_id(tag)
+        keys = [self._key(path) for path in paths]
+        self.conn.executemany("INSERT OR IGNORE INTO images (path) VALUES (?)", ((key,) for key in keys))
+        cursor = self.conn.executemany('''
+            INSERT OR IGNORE INTO image_tags (image_id, tag_id)
+            SELECT id, ? FROM images WHERE path = ?
+        ''', ((tag_id, key) for key in keys))
+        for path in paths:
+            self._cache_tag(path, tag, True)
+        return cursor.rowcount
+
+    def remove_tag_many(self, paths, tag):
+        self.flush()
+        row = self.conn.execute("SELECT id FROM tags WHERE name = ?", (tag,)).fetchone()
+        if row is None:
+            return 0
+        cursor = self.conn.executemany('''
+            DELETE FROM image_tags
+            WHERE image_id = (SELECT id FROM images WHERE path = ?) AND tag_id = ?
+        ''', ((self._key(path), row[0]) for path in paths))
+        for path in paths:
+            self._cache_tag(path, tag, False)
+        return cursor.rowcount
+
+    def get_tags(self, path):
+        if self.tag_cache is not None:
+            return list(self.tag_cache.get(path, ()))
+        rows = self.conn.execute('''
+            SELECT tags.name FROM images
+            JOIN image_tags ON image_tags.image_id = images.id
+            JOIN tags ON tags.id = image_tags.tag_id
+            WHERE images.path = ?
+            ORDER BY tags.id
+        ''', (self._key(path),))
+        tags = [row[0] for row in rows]
+        for tag, add in self.pending.get(path, {}).items():
+            if add and tag not in tags:
+                tags.append(tag)
+            elif not add and tag in tags:
+                tags.remove(tag)
+        return tags
+
+    def add_tag(self, path, tag):
+        self._queue(path, tag, True)
+
+    def remove_tag(self, path, tag):
+        self._queue(path, tag, False)
+
+    def create_rename_batch(self, mapping):
+        self.flush()
+        batch_id = self.conn.execute("INSERT INTO rename_batches (phase) VALUES (0)").lastrowid
+        self.conn.executemany(
+            "INSERT INTO rename_journal (batch_id, seq, old_path, tmp_path, new_path) VALUES (?, ?, ?, ?, ?)",
+            (
+                (batch_id, seq, old_path,
+                 os.path.join(os.path.dirname(old_path), f".ilms-{batch_id}-{seq}.renaming"), new_path)
+                for seq, (old_path, new_path) in enumerate(mapping)
+            )
+        )
+        self.conn.commit()
+        return batch_id
+
+    def pending_rename_batches(self):
+        return [row[0] for row in self.conn.execute("SELECT id FROM rename_batches ORDER BY id")]
+
+    def rename_batch(self, batch_id):
+        phase = self.conn.execute("SELECT phase FROM rename_batches WHERE id = ?", (batch_id,)).fetchone()[0]
+        entries = self.conn.execute(
+            "SELECT old_path, tmp_path, new_path FROM rename_journal WHERE batch_id = ? ORDER BY seq",
+            (batch_id,)
+        ).fetchall()
+        return phase, entries
+
+    def set_rename_phase(self, batch_id, phase):
+        self.conn.execute("UPDATE rename_batches SET phase = ? WHERE id = ?", (phase, batch_id))
+        self.conn.commit()
+
+    def finish_rename_batch(self, batch_id, renamed):
+        self.flush()
+        self.conn.executemany(
+            "UPDATE images SET path = ? WHERE path = ?",
+            ((self._key(tmp_path), self._key(old_path)) for old_path, tmp_path, _ in renamed)
+        )
+        self.conn.executemany(
+            "DELETE FROM images WHERE path = ?", ((self._key(new_path),) for _, _, new_path in renamed)
+        )
+        self.conn.executemany(
+            "UPDATE images SET path = ? WHERE path = ?",
+            ((self._key(new_path), self._key(tmp_path)) for _, tmp_path, new_path in renamed)
+        )
+        self._rename_cached((old_path, new_path) for old_path, _, new_path in renamed)
+        self.discard_rename_batch(batch_id)
+
+    def discard_rename_batch(self, batch_id):
+        self.conn.execute("DELETE FROM rename_batches WHERE id = ?", (batch_id,))
+        self.conn.commit()
+
+    def delete_unlabeled(self, paths):
+        self.flush()
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS deleted_paths (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.execute("DELETE FROM temp.deleted_paths")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO temp.deleted_paths (path) VALUES (?)", ((self._key(path),) for path in paths)
+        )
+        cursor = self.conn.execute(
+            "DELETE FROM images WHERE tag_count = 0 AND path IN (SELECT path FROM temp.deleted_paths)"
+        )
+        self.conn.execute("DELETE FROM temp.deleted_paths")
+        self.conn.commit()
+        return cursor.rowcount
+
+    def _iter_rows(self, sql, parameters=(), batch_size=10000):
+        self.flush()
+        cursor = self.conn.execute(sql, parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_images_with_tag(self, tag):
+        for row in self._iter_rows('''
+            SELECT images.path FROM tags
+            JOIN image_tags ON image_tags.tag_id = tags.id
+            JOIN images ON images.id = image_tags.image_id
+            WHERE tags.name = ?
+        ''', (tag,)):
+            yield self._path(row[0])
+
+    def iter_tagged_paths(self):
+        for row in self._iter_rows("SELECT path FROM images WHERE tag_count > 0"):
+            yield self._path(row[0])
+
+    def iter_unlabeled_paths(self):
+        for row in self._iter_rows("SELECT path FROM images WHERE tag_count = 0"):
+            yield self._path(row[0])
+
+    def images_with_tag(self, tag):
+        return list(self.iter_images_with_tag(tag))
+
+    def iter_labels(self, scope=None):
+        rows = self._iter_rows('''
+            SELECT images.id, images.path, tags.id, tags.name FROM images
+            JOIN image_tags ON image_tags.image_id = images.id
+            JOIN tags ON tags.id = image_tags.tag_id
+            WHERE images.path >= ? AND images.path < ? AND images.tag_count > 0
+            ORDER BY images.path, image_tags.tag_id
+        ''', path_range(scope and self._key(scope)))
+        for image_id, path, tag_id, tag in rows:
+            yield image_id, self._path(path), tag_id, tag
+
+    def iter_image_tags(self, scope=None):
+        for path, rows in groupby(self.iter_labels(scope), key=itemgetter(1)):
+            yield path, [row[3] for row in rows]
+
+    def import_tags(self, records, policy='union', batch_size=10000):
+        if policy not in MERGE_POLICIES:
+            raise ValueError(f"未知的合并策略: {policy}")
+        self.flush()
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_paths (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS import_tags (path TEXT, tag TEXT, PRIMARY KEY (path, tag)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_seen (image_id INTEGER PRIMARY KEY, tagged INTEGER)")
+        self.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS import_pairs (image_id INTEGER, tag_id INTEGER, "
+            "PRIMARY KEY (image_id, tag_id)) WITHOUT ROWID"
+        )
+        totals = [0, 0, 0, 0]
+        batch = {}
+        try:
+            for path, tags in records:
+                batch.setdefault(self._key(path), set()).update(tags)
+                if len(batch) >= batch_size:
+                    self._import_batch(batch, policy, totals)
+                    batch = {}
+            if batch:
+                self._import_batch(batch, policy, totals)
+            if policy == 'overwrite':
+                totals[2] = self.conn.execute('''
+                    DELETE FROM image_tags
+                    WHERE image_id IN (SELECT image_id FROM temp.import_seen)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM temp.import_pairs
+                          WHERE import_pairs.image_id = image_tags.image_id AND import_pairs.tag_id = image_tags.tag_id
+                      )
+                ''').rowcount
+            images, tagged = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tagged), 0) FROM temp.import_seen"
+            ).fetchone()
+            totals[0] = images
+            if policy == 'skip':
+                totals[3] = tagged
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.execute("DELETE FROM temp.import_paths")
+            self.conn.execute("DELETE FROM temp.import_tags")
+            self.conn.execute("DELETE FROM temp.import_seen")
+            self.conn.execute("DELETE FROM temp.import_pairs")
+        if self.tag_cache is not None:
+            self.load_tags()
+        return tuple(totals)
+
+    def _import_batch(self, batch, policy, totals):
+        self.conn.execute("DELETE FROM temp.import_paths")
+        self.conn.execute("DELETE FROM temp.import_tags")
+        self.conn.executemany("INSERT INTO temp.import_paths (path) VALUES (?)", ((path,) for path in batch))
+        self.conn.executemany(
+            "INSERT INTO temp.import_tags (path, tag) VALUES (?, ?)",
+            ((path, tag) for path, tags in batch.items() for tag in tags)
+        )
+        self.conn.execute("INSERT OR IGNORE INTO tags (name) SELECT DISTINCT tag FROM temp.import_tags")
+        self.conn.execute("INSERT OR IGNORE INTO images (path) SELECT path FROM temp.import_paths")
+        self.conn.execute('''
+            INSERT OR IGNORE INTO temp.import_seen (image_id, tagged)
+            SELECT images.id, images.tag_count > 0 FROM temp.import_paths JOIN images USING (path)
+        ''')
+        if policy == 'skip':
+            self.conn.execute('''
+                DELETE FROM temp.import_tags WHERE (
+                    SELECT import_seen.tagged FROM images
+                    JOIN temp.import_seen ON import_seen.image_id = images.id
+                    WHERE images.path = import_tags.path
+                )
+            ''')
+        elif policy == 'overwrite':
+            self.conn.execute('''
+                INSERT OR IGNORE INTO temp.import_pairs (image_id, tag_id)
+                SELECT images.id, tags.id FROM temp.import_tags
+                JOIN images ON images.path = import_tags.path
+                JOIN tags ON tags.name = import_tags.tag
+            ''')
+        totals[1] += self.conn.execute('''
+            INSERT OR IGNORE INTO image_tags (image_id, tag_id)
+            SELECT images.id, tags.id FROM temp.import_tags
+            JOIN images ON images.path = import_tags.path
+            JOIN tags ON tags.name = import_tags.tag
+        ''').rowcount
+
+    def merge_dataset(self, path, root):
+        self.flush()
+        relative = os.path.relpath(root, self.root)
+        prefix = os.path.join(relative, '')
+        columns = ', '.join(name for name, _ in IMAGE_COLUMNS)
+        self.conn.execute("ATTACH DATABASE ? AS nested", (path,))
+        try:
+            self.conn.execute(f'''
+                INSERT OR IGNORE INTO images (path, {columns})
+                SELECT ? || path, {columns} FROM nested.images WHERE path != ''
+            ''', (prefix,))
+            self.conn.execute("INSERT OR IGNORE INTO tags (name) SELECT name FROM nested.tags")
+            self.conn.execute('''
+                INSERT OR IGNORE INTO image_tags (image_id, tag_id)
+                SELECT images.id, tags.id FROM nested.image_tags AS pairs
+                JOIN nested.images AS nested_images ON nested_images.id = pairs.image_id
+                JOIN nested.tags AS nested_tags ON nested_tags.id = pairs.tag_id
+                JOIN images ON images.path = ? || nested_images.path
+                JOIN tags ON tags.name = nested_tags.name
+            ''', (prefix,))
+            self.conn.execute("INSERT OR IGNORE INTO organize_targets (root) SELECT root FROM nested.organize_targets")
+            self.conn.execute('''
+                INSERT OR IGNORE INTO organize_manifest (target_id, image_id, tag_id, dest)
+                SELECT organize_targets.id, images.id, tags.id, manifest.dest FROM nested.organize_manifest AS manifest
+                JOIN nested.organize_targets AS nested_targets ON nested_targets.id = manifest.target_id
+                JOIN nested.images AS nested_images ON nested_images.id = manifest.image_id
+                JOIN nested.tags AS nested_tags ON nested_tags.id = manifest.tag_id
+                JOIN organize_targets ON organize_targets.root = nested_targets.root
+                JOIN images ON images.path = ? || nested_images.path
+                JOIN tags ON tags.name = nested_tags.name
+            ''', (prefix,))
+            self.conn.execute("UPDATE organize_targets SET change_seq = NULL")
+            batches = self.conn.execute("SELECT id, phase FROM nested.rename_batches ORDER BY id").fetchall()
+            for batch_id, phase in batches:
+                new_id = self.conn.execute("INSERT INTO rename_batches (phase) VALUES (?)", (phase,)).lastrowid
+                self.conn.execute('''
+                    INSERT INTO rename_journal (batch_id, seq, old_path, tmp_path, new_path)
+                    SELECT ?, seq, old_path, tmp_path, new_path FROM nested.rename_journal WHERE batch_id = ?
+                ''', (new_id, batch_id))
+            self.conn.execute('''
+                INSERT OR REPLACE INTO scan_snapshots (directory, mtime_ns, files, subdirectories)
+                SELECT CASE WHEN directory = '' THEN ? ELSE ? || directory END, mtime_ns, files, subdirectories
+                FROM nested.scan_snapshots
+            ''', (relative, prefix))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.execute("DETACH DATABASE nested")
+
+    def tagged_images(self):
+        self.flush()
+        rows = self.conn.execute('''
+            SELECT images.path, tags.name FROM images
+            JOIN image_tags ON image_tags.image_id = images.id
+            JOIN tags ON tags.id = image_tags.tag_id
+            WHERE images.tag_count > 0
+            ORDER BY images.id
+        ''')
+        tagged = []
+        last = None
+        for path, tag in rows:
+            if path == last:
+                tagged[-1][1].append(tag)
+            else:
+                last = path
+                tagged.append((self._path(path), [tag]))
+        return tagged
+
+    def organize_target(self, root):
+        self.flush()
+        row = self.conn.execute("SELECT id, change_seq FROM organize_targets WHERE root = ?", (root,)).fetchone()
+        if row is not None:
+            return row[0], row[1]
+        cursor = self.conn.execute("INSERT INTO organize_targets (root) VALUES (?)", (root,))
+        self.conn.commit()
+        return cursor.lastrowid, None
+
+    def reset_organize_target(self, root):
+        self.flush()
+        self.conn.execute("DELETE FROM organize_targets WHERE root = ?", (root,))
+        self._prune_tag_changes()
+        self.conn.commit()
+
+    def change_seq(self):
+        self.flush()
+        return self.conn.execute(
+            "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'tag_changes'), "
+            "(SELECT MAX(seq) FROM tag_changes), 0)").fetchone()[0]
+
+    def organize_changes(self, target_id, since, until):
+        if since is None:
+            pairs = '''
+                SELECT image_id, tag_id FROM image_tags
+                UNION SELECT image_id, tag_id FROM organize_manifest WHERE target_id = :target
+            '''
+        else:
+            pairs = "SELECT DISTINCT image_id, tag_id FROM tag_changes WHERE seq > :since AND seq <= :until"
+        rows = self._iter_rows(f'''
+            SELECT changed.image_id, changed.tag_id,
+                   CASE WHEN image_tags.image_id IS NULL THEN NULL ELSE images.path END,
+                   tags.name, images.phash, organize_manifest.dest
+            FROM ({pairs}) AS changed
+            LEFT JOIN image_tags ON image_tags.image_id = changed.image_id AND image_tags.tag_id = changed.tag_id
+            LEFT JOIN images ON images.id = changed.image_id
+            LEFT JOIN tags ON tags.id = changed.tag_id
+            LEFT JOIN organize_manifest ON organize_manifest.target_id = :target
+                AND organize_manifest.image_id = changed.image_id AND organize_manifest.tag_id = changed.tag_id
+            ORDER BY changed.image_id
+        ''', {'target': target_id, 'since': since, 'until': until})
+        return [(image_id, tag_id, path and self._path(path), tag,
+                 None if value is None else value & 0xFFFFFFFFFFFFFFFF, dest)
+                for image_id, tag_id, path, tag, value, dest in rows]
+
+    def organized_tags(self, target_id):
+        return self.conn.execute('''
+            SELECT id, name FROM tags WHERE EXISTS (
+                SELECT 1 FROM organize_manifest WHERE target_id = ? AND tag_id = tags.id
+            )
+        ''', (target_id,)).fetchall()
+
+    def forget_organized_tags(self, target_id, tag_ids):
+        self.conn.executemany(
+            "DELETE FROM organize_manifest WHERE target_id = ? AND tag_id = ?",
+            ((target_id, tag_id) for tag_id in tag_ids)
+        )
+        self.conn.commit()
+
+    def organize_directories(self):
+        roots = [root for (root,) in self.conn.execute("SELECT root FROM organize_targets")]
+        if not roots:
+            return set()
+        tags = [name for (name,) in self.conn.execute("SELECT name FROM tags")]
+        return {os.path.join(root, tag) for root in roots for tag in tags}
+
+    def organized_hashes(self, target_id, tag_id):
+        for (value,) in self._iter_rows('''
+            SELECT images.phash FROM organize_manifest
+            JOIN images ON images.id = organize_manifest.image_id
+            WHERE organize_manifest.target_id = ? AND organize_manifest.tag_id = ? AND images.phash IS NOT NULL
+        ''', (target_id, tag_id)):
+            yield value & 0xFFFFFFFFFFFFFFFF
+
+    def record_organized(self, target_id, placed, removed, change_seq=None):
+        self.flush()
+        self.conn.executemany(
+            "DELETE FROM organize_manifest WHERE target_id = ? AND image_id = ? AND tag_id = ?",
+            ((target_id, image_id, tag_id) for image_id, tag_id in removed)
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO organize_manifest (target_id, image_id, tag_id, dest) VALUES (?, ?, ?, ?)",
+            ((target_id, image_id, tag_id, dest) for image_id, tag_id, dest in placed)
+        )
+        if change_seq is not None:
+            self.conn.execute("UPDATE organize_targets SET change_seq = ? WHERE id = ?", (change_seq, target_id))
+            self._prune_tag_changes()
+        self.conn.commit()
+
+    def _prune_tag_changes(self):
+        self.conn.execute(
+            "DELETE FROM tag_changes WHERE seq <= COALESCE((SELECT MIN(change_seq) FROM organize_targets), "
+            "(SELECT MAX(seq) FROM tag_changes))"
+        )
+
+    def scan_snapshot(self, folder, recursive=False):
+        key = self._key(folder)
+        if recursive:
+            rows = self.conn.execute(
+                "SELECT directory, mtime_ns, files, subdirectories FROM scan_snapshots "
+                "WHERE directory = ? OR (directory >= ? AND directory < ?)", (key, *path_range(key))
+            )
+        else:
+            rows = self.conn.execute(
+                "SELECT directory, mtime_ns, files, subdirectories FROM scan_snapshots WHERE directory = ?", (key,)
+            )
+        return {
+            self._path(directory) if directory else self.root:
+                (mtime_ns, decode_names(files), decode_names(subdirectories))
+            for directory, mtime_ns, files, subdirectories in rows
+        }
+
+    def save_scan_snapshot(self, directories, removed=()):
+        self.conn.executemany("DELETE FROM scan_snapshots WHERE directory = ?", ((self._key(d),) for d in removed))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO scan_snapshots (directory, mtime_ns, files, subdirectories) VALUES (?, ?, ?, ?)",
+            ((self._key(directory), mtime_ns, encode_names(files), encode_names(subdirectories))
+             for directory, mtime_ns, files, subdirectories in directories)
+        )
+        self.conn.commit()
+
+    def unlabeled_paths(self):
+        return list(self.iter_unlabeled_paths())
+
+    def stats(self):
+        self.flush()
+        images, tagged = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(tag_count > 0), 0) FROM images"
+        ).fetchone()
+        tag_counts = self.conn.execute('''
+            SELECT tags.name, COUNT(image_tags.image_id) FROM tags
+            LEFT JOIN image_tags ON image_tags.tag_id = tags.id
+            GROUP BY tags.id ORDER BY COUNT(image_tags.image_id) DESC, tags.name
+        ''').fetchall()
+        return {
+            'images': images,
+            'tagged': tagged,
+            'unlabeled': images - tagged,
+            'tags': dict(tag_counts),
+            'pending_renames': len(self.pending_rename_batches()),
+        }
+
+    def all_tags(self):
+        self.flush()
+        return [row[0] for row in self.conn.execute("SELECT name FROM tags ORDER BY name")]
+
+    def file_identities(self, scope=None):
+        rows = self._iter_rows(
+            "SELECT path, inode, mtime_ns, size, content_key, full_hash FROM images "
+            "WHERE path >= ? AND path < ? AND content_key IS NOT NULL", path_range(scope and self._key(scope))
+        )
+        return {self._path(row[0]): row[1:] for row in rows}
+
+    def identities_for(self, paths):
+        identities = {}
+        for path in paths:
+            row = self.conn.execute(
+                "SELECT inode, mtime_ns, size, content_key, full_hash FROM images "
+                "WHERE path = ? AND content_key IS NOT NULL", (self._key(path),)
+            ).fetchone()
+            if row is not None:
+                identities[path] = row
+        return identities
+
+    def reconcile(self, identities):
+        self.flush()
+        identities = {identity[0]: identity for identity in
+                      ((self._key(identity[0]),) + tuple(identity[1:]) for identity in identities)}
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO images (path) VALUES (?)", ((key,) for key in identities)
+        )
+        self.conn.executemany(
+            "UPDATE images SET inode = ?, mtime_ns = ?, size = ?, content_key = ?, full_hash = ? WHERE path = ?",
+            (identity[1:] + identity[:1] for identity in identities.values())
+        )
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS changed_paths (path TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM changed_paths")
+        self.conn.executemany("INSERT INTO changed_paths (path) VALUES (?)", ((path,) for path in identities))
+        rows = self.conn.execute('''
+            SELECT id, path, full_hash, content_key, path IN (SELECT path FROM changed_paths), tag_count
+            FROM images WHERE content_key IN (
+                SELECT images.content_key FROM changed_paths
+                JOIN images ON images.path = changed_paths.path
+                WHERE images.tag_count = 0
+            )
+        ''')
+        groups = {}
+        for image_id, path, full_hash, content_key, changed, tag_count in rows:
+            new_rows, old_rows = groups.setdefault(content_key, ([], []))
+            if not changed:
+                old_rows.append((image_id, path, full_hash))
+            elif tag_count == 0:
+                new_rows.append((image_id, path, full_hash))
+        
+        candidates = {}
+        claims = {}
+        old_paths = {}
+        for new_rows, old_rows in groups.values():
+            for old_id, old_path, old_full_hash in old_rows:
+                if os.path.exists(self._path(old_path)):
+                    continue
+                for new_id, new_path, new_full_hash in new_rows:
+                    if old_full_hash and new_full_hash and old_full_hash != new_full_hash:
+                        continue
+                    candidates.setdefault(old_id, []).append((new_id, new_path))
+                    old_paths[old_id] = old_path
+                    claims[new_id] = claims.get(new_id, 0) + 1
+        moves = [(old_id, *targets[0]) for old_id, targets in candidates.items()
+                 if len(targets) == 1 and claims[targets[0][0]] == 1]
+        
+        self.conn.executemany("DELETE FROM images WHERE id = ?", ((new_id,) for _, new_id, _ in moves))
+        self.conn.executemany(
+            "UPDATE images SET path = ?, inode = ?, mtime_ns = ?, size = ?, content_key = ?, full_hash = ? "
+            "WHERE id = ?",
+            (identities[new_path] + (old_id,) for old_id, _, new_path in moves)
+        )
+        moved = [(self._path(old_paths[old_id]), self._path(new_path)) for old_id, _, new_path in moves]
+        self._rename_cached(moved)
+        return moved
+
+    def unhashed_paths(self):
+        return [self._path(row[0]) for row in self.conn.execute("SELECT path FROM images WHERE phash IS NULL")]
+
+    def set_perceptual_hashes(self, hashes):
+        self.conn.executemany(
+            "UPDATE images SET phash = ? WHERE path = ?",
+            ((value - (1 << 64) if value >= 1 << 63 else value, self._key(path)) for path, value in hashes)
+        )
+        self.conn.commit()
+
+    def iter_perceptual_hashes(self):
+        for path, value in self._iter_rows("SELECT path, phash FROM images WHERE phash IS NOT NULL"):
+            yield self._path(path), value & 0xFFFFFFFFFFFFFFFF
+
+QUERY_TOKEN = re.compile(r'\s*(?:(\()|(\))|(&&|\|\||&|\||!)|"((?:[^"\\]|\\.)*)"|([^\s()"&|!]+))')
+QUERY_SYMBOLS = {'&': 'AND', '&&': 'AND', '|': 'OR', '||': 'OR', '!': 'NOT'}
+
+def tokenize_query(text):
+    tokens = []
+    text = text.strip()
+    position = 0
+    while position < len(text):
+        match = QUERY_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f"无法解析查询: {text[position:]}")
+        position = match.end()
+        open_paren, close_paren, symbol, quoted, word = match.groups()
+        if open_paren:
+            tokens.append(('(', None))
+        elif close_paren:
+            tokens.append((')', None))
+        elif symbol:
+            tokens.append((QUERY_SYMBOLS[symbol], None))
+        elif quoted is not None:
+            tokens.append(('TAG', re.sub(r'\\(.)', r'\1', quoted)))
+        elif word.upper() in ('AND', 'OR', 'NOT'):
+            tokens.append((word.upper(), None))
+        elif word.lower() in ('tagged', 'untagged'):
+            tokens.append((word.upper(), None))
+        elif word.endswith('*'):
+            tokens.append(('PREFIX', word[:-1]))
+        else:
+            tokens.append(('TAG', word))
+    return tokens
+
+def parse_query(text):
+    tokens = tokenize_query(text)
+    if not tokens:
+        raise ValueError("查询为空")
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == 'OR':
+            take()
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() in ('AND', 'NOT', 'TAG', 'PREFIX', 'TAGGED', 'UNTAGGED', '('):
+            if peek() == 'AND':
+                take()
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def parse_not():
+        if peek() == 'NOT':
+            take()
+            return ('not', parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        kind = peek()
+        if kind is None:
+            raise ValueError("查询意外结束")
+        _, value = take()
+        if kind == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError("缺少右括号")
+            take()
+            return node
+        if kind == 'TAG':
+            return ('tag', value)
+        if kind == 'PREFIX':
+            return ('prefix', value)
+        if kind == 'TAGGED':
+            return ('tagged',)
+        if kind == 'UNTAGGED':
+            return ('untagged',)
+        raise ValueError(f"查询中出现意外的 {kind}")
+
+    node = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"查询中出现意外的 {tokens[position][0]}")
+    return node
+
+def _compile_node(node, params):
+    kind = node[0]
+    if kind == 'tag':
+        params.append(node[1])
+        return "SELECT image_id FROM image_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)"
+    if kind == 'prefix':
+        prefix = node[1]
+        if not prefix:
+            return "SELECT id FROM images WHERE tag_count > 0"
+        params.extend((prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        return ("SELECT image_id FROM image_tags WHERE tag_id IN "
+                "(SELECT id FROM tags WHERE name >= ? AND name < ?)")
+    if kind == 'tagged':
+        return "SELECT id FROM images WHERE tag_count > 0"
+    if kind == 'untagged':
+        return "SELECT id FROM images WHERE tag_count = 0"
+    if kind == 'or':
+        return " UNION ".join(f"SELECT * FROM ({_compile_node(child, params)})" for child in node[1])
+    if kind == 'not':
+        return f"SELECT id FROM images EXCEPT SELECT * FROM ({_compile_node(node[1], params)})"
+    positives = [child for child in node[1] if child[0] != 'not']
+    negatives = [child[1] for child in node[1] if child[0] == 'not']
+    if positives:
+        sql = " INTERSECT ".join(f"SELECT * FROM ({_compile_node(child, params)})" for child in positives)
+    else:
+        sql = "SELECT id FROM images"
+    for child in negatives:
+        sql += f" EXCEPT SELECT * FROM ({_compile_node(child, params)})"
+    return sql
+
+def compile_query(text, schema=None):
+    params = []
+    sql = _compile_node(parse_query(text), params)
+    if schema:
+        sql = re.sub(r'\b(images|image_tags|tags)\b', schema + r'.\1', sql)
+    return sql, params
+
+def path_range(scope=None):
+    if not scope:
+        return ('', '\U0010ffff')
+    scope = scope.rstrip('/\\') + os.sep
+    return (scope, scope[:-1] + chr(ord(scope[-1]) + 1))
+
+class QueryCursor:
+    def __init__(self, db, expression, scope=None, page_size=500):
+        self.db = db
+        self.expression = expression
+        self.match_sql, self.match_params = compile_query(expression)
+        self.scope = path_range(scope and db._key(scope))
+        self.page_size = page_size
+        self.page = []
+
+    def _where(self, comparison):
+        return (f"WHERE path {comparison} ? AND path >= ? AND path < ? "
+                f"AND id IN ({self.match_sql})")
+
+    def _fetch(self, comparison, path, order, limit):
+        self.db.flush()
+        rows = self.db.conn.execute(
+            f"SELECT path FROM images {self._where(comparison)} ORDER BY path {order} LIMIT ?",
+            [path, *self.scope, *self.match_params, limit]
+        )
+        return [row[0] for row in rows]
+
+    def count(self):
+        self.db.flush()
+        return self.db.conn.execute(
+            f"SELECT COUNT(*) FROM images {self._where('>=')}", ['', *self.scope, *self.match_params]
+        ).fetchone()[0]
+
+    def invalidate(self):
+        self.page = []
+
+    def add_tag(self, tag):
+        self.db.flush()
+        paths = list(self) if self.db.tag_cache is not None else ()
+        cursor = self.db.conn.execute(
+            f"INSERT OR IGNORE INTO image_tags (image_id, tag_id) SELECT id, ? FROM images {self._where('>=')}",
+            [self.db._tag_id(tag), '', *self.scope, *self.match_params]
+        )
+        for path in paths:
+            self.db._cache_tag(path, tag, True)
+        self.invalidate()
+        return cursor.rowcount
+
+    def remove_tag(self, tag):
+        self.db.flush()
+        row = self.db.conn.execute("SELECT id FROM tags WHERE name = ?", (tag,)).fetchone()
+        if row is None:
+            return 0
+        paths = list(self) if self.db.tag_cache is not None else ()
+        cursor = self.db.conn.execute(
+            f"DELETE FROM image_tags WHERE tag_id = ? AND image_id IN (SELECT id FROM images {self._where('>=')})",
+            [row[0], '', *self.scope, *self.match_params]
+        )
+        for path in paths:
+            self.db._cache_tag(path, tag, False)
+        self.invalidate()
+        return cursor.rowcount
+
+    def next_after(self, path=None, inclusive=False):
+        key = self.db._key(path) if path else ''
+        page = self.page
+        i = bisect.bisect_left(page, key) if inclusive else bisect.bisect_right(page, key)
+        if 0 < i < len(page) or (i == 0 and page and page[0] == key):
+            return self.db._path(page[i])
+        self.page = self._fetch('>=' if inclusive else '>', key, 'ASC', self.page_size)
+        return self.db._path(self.page[0]) if self.page else None
+
+    def prev_before(self, path=None):
+        key = self.db._key(path) if path else '\U0010ffff'
+        page = self.page
+        i = bisect.bisect_left(page, key)
+        if 0 < i < len(page):
+            return self.db._path(page[i - 1])
+        self.page = self._fetch('<', key, 'DESC', self.page_size)[::-1]
+        return self.db._path(self.page[-1]) if self.page else None
+
+    def __iter__(self):
+        key = ''
+        while True:
+            page = self._fetch('>', key, 'ASC', self.page_size)
+            if not page:
+                return
+            for key in page:
+                yield self.db._path(key)
+
+TAG_FORMATS = ('csv', 'jsonl', 'coco')
+MERGE_POLICIES = ('union', 'overwrite', 'skip')
+
+def guess_tag_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    return {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'coco'}.get(extension)
+
+def export_tags(db, file, fmt='csv', root=None, scope=None):
+    import csv
+    import json
+
+    def name(path):
+        return os.path.relpath(path, root) if root else path
+
+    if fmt == 'coco':
+        return write_coco(db, file, name, scope)
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(('path', 'tag'))
+        for path, tags in db.iter_image_tags(scope):
+            writer.writerows((name(path), tag) for tag in tags)
+            count += 1
+    elif fmt == 'jsonl':
+        for path, tags in db.iter_image_tags(scope):
+            file.write(json.dumps({'path': name(path), 'tags': tags}, ensure_ascii=False) + '\n')
+            count += 1
+    else:
+        raise ValueError(f"未知的标签文件格式: {fmt}")
+    return count
+
+def write_coco(db, file, name, scope=None):
+    import json
+    count = 0
+    file.write('{"images": [')
+    for image_id, rows in groupby(db.iter_labels(scope), key=itemgetter(0)):
+        path = next(rows)[1]
+        file.write(',\n' if count else '\n')
+        file.write(json.dumps({'id': image_id, 'file_name': name(path)}, ensure_ascii=False))
+        count += 1
+    categories = {}
+    file.write('\n],\n"annotations": [')
+    for annotation_id, (image_id, _, tag_id, tag) in enumerate(db.iter_labels(scope), 1):
+        categories[tag_id] = tag
+        file.write(',\n' if annotation_id > 1 else '\n')
+        file.write(json.dumps({'id': annotation_id, 'image_id': image_id, 'category_id': tag_id}))
+    file.write('\n],\n"categories": [')
+    file.write(','.join('\n' + json.dumps({'id': tag_id, 'name': tag}, ensure_ascii=False)
+                        for tag_id, tag in sorted(categories.items())))
+    file.write('\n]}\n')
+    return count
+
+def resolve_path(path, root=None):
+    return os.path.abspath(os.path.join(root, path) if root else path)
+
+def read_tags(file, fmt='csv', root=None):
+    import csv
+    import json
+    if fmt == 'csv':
+        rows = csv.DictReader(file)
+        if not rows.fieldnames or 'path' not in rows.fieldnames:
+            raise ValueError("CSV 文件缺少 path 列")
+        for path, group in groupby(rows, key=itemgetter('path')):
+            yield resolve_path(path, root), [row['tag'] for row in group if row.get('tag')]
+    elif fmt == 'jsonl':
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield resolve_path(record['path'], root), record.get('tags', [])
+    elif fmt == 'coco':
+        yield from read_coco(file, root)
+    else:
+        raise ValueError(f"未知的标签文件格式: {fmt}")
+
+class JSONStream:
+    def __init__(self, file, chunk_size=1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        import json
+        self.decoder = json.JSONDecoder()
+
+    def _read(self):
+        data = self.file.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return bool(data)
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                raise ValueError("JSON 文件意外结束")
+
+    def expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f"JSON 格式错误: 应为 {' 或 '.join(chars)}，实际为 {char}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer):
+                    self.pos = end
+                    return value
+            except ValueError:
+                pass
+            if not self._read():
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+
+    def items(self):
+        self.expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def keys(self):
+        self.expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+def read_coco(file, root=None):
+    stream = JSONStream(file)
+    staging = sqlite3.connect('')
+    try:
+        staging.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, path TEXT NOT NULL)")
+        staging.execute("CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+        staging.execute("CREATE TABLE annotations (image_id INTEGER NOT NULL, category_id INTEGER NOT NULL)")
+        for key in stream.keys():
+            if key == 'images':
+                staging.executemany(
+                    "INSERT OR REPLACE INTO images (id, path) VALUES (?, ?)",
+                    ((item['id'], resolve_path(item['file_name'], root)) for item in stream.items())
+                )
+            elif key == 'categories':
+                staging.executemany(
+                    "INSERT OR REPLACE INTO categories (id, name) VALUES (?, ?)",
+                    ((item['id'], str(item['name'])) for item in stream.items())
+                )
+            elif key == 'annotations':
+                staging.executemany(
+                    "INSERT INTO annotations (image_id, category_id) VALUES (?, ?)",
+                    ((item['image_id'], item['category_id']) for item in stream.items())
+                )
+            else:
+                stream.value()
+        staging.execute("CREATE INDEX annotations_image ON annotations (image_id)")
+        rows = staging.execute('''
+            SELECT images.id, images.path, categories.name FROM images
+            LEFT JOIN annotations ON annotations.image_id = images.id
+            LEFT JOIN categories ON categories.id = annotations.category_id
+            ORDER BY images.id
+        ''')
+        for _, group in groupby(rows, key=itemgetter(0)):
+            group = list(group)
+            yield group[0][1], [row[2] for row in group if row[2] is not None]
+    finally:
+        staging.close()
+
+def import_tags(db, file, fmt='csv', policy='union', root=None, batch_size=10000):
+    return db.import_tags(read_tags(file, fmt, root), policy, batch_size)
+
+DATASET_DB_NAME = '.image_tags.db'
+LEGACY_DB_NAME = 'image_tags.db'
+MAX_ATTACHED = 10
+
+def user_data_dir():
+    return os.environ.get('IMAGE_LABEL_HOME') or os.path.join(os.path.expanduser('~'), '.image_label')
+
+class DatasetRegistry:
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(user_data_dir(), exist_ok=True)
+            path = os.path.join(user_data_dir(), 'datasets.db')
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS datasets (
+                root TEXT PRIMARY KEY,
+                db_path TEXT NOT NULL,
+                last_opened REAL NOT NULL
+            )
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, root, db_path):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO datasets (root, db_path, last_opened) VALUES (?, ?, ?)",
+            (root, db_path, time.time())
+        )
+        self.conn.commit()
+
+    def remove(self, root):
+        removed = self.conn.execute("DELETE FROM datasets WHERE root = ?", (root,)).rowcount
+        self.conn.commit()
+        return removed
+
+    def datasets(self):
+        return self.conn.execute("SELECT root, db_path FROM datasets ORDER BY last_opened DESC").fetchall()
+
+    def nested(self, folder):
+        prefix = os.path.join(folder, '')
+        return [(root, db_path) for root, db_path in self.datasets()
+                if root.startswith(prefix) and os.path.isfile(db_path)]
+
+    def find(self, folder):
+        best = None
+        for root, db_path in self.datasets():
+            if folder != root and not folder.startswith(os.path.join(root, '')):
+                continue
+            if best is None or len(root) > len(best[0]):
+                best = (root, db_path)
+        return best
+
+def find_dataset_root(folder):
+    path = folder
+    while True:
+        if os.path.isfile(os.path.join(path, DATASET_DB_NAME)):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def shard_path(root):
+    if os.access(root, os.W_OK):
+        return os.path.join(root, DATASET_DB_NAME)
+    digest = hashlib.blake2b(root.encode('utf-8', 'surrogateescape'), digest_size=8).hexdigest()
+    shards = os.path.join(user_data_dir(), 'shards')
+    os.makedirs(shards, exist_ok=True)
+    return os.path.join(shards, f"{digest}.db")
+
+def retire_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.replace(path + suffix, path + '.merged' + suffix)
+
+def open_dataset(folder, cache_mb=64, legacy_db=None, registry=None, create=True):
+    folder = os.path.abspath(folder)
+    own_registry = registry is None
+    registry = registry or DatasetRegistry()
+    try:
+        root = find_dataset_root(folder)
+        if root is not None:
+            db_path = os.path.join(root, DATASET_DB_NAME)
+        else:
+            root, db_path = registry.find(folder) or (folder, shard_path(folder))
+        created = not os.path.exists(db_path)
+        if created and not create:
+            raise ValueError(f"{folder} 不属于任何已有的数据集")
+        db = TagDatabase(db_path, cache_mb, root=root)
+        if created:
+            for nested_root, nested_path in registry.nested(root):
+                TagDatabase(nested_path, root=nested_root).close()
+                db.merge_dataset(nested_path, nested_root)
+                retire_database(nested_path)
+                registry.remove(nested_root)
+        if created and legacy_db and os.path.isfile(legacy_db) and os.path.abspath(legacy_db) != db_path:
+            legacy = TagDatabase(legacy_db)
+            try:
+                db.import_tags(legacy.iter_image_tags(root))
+            finally:
+                legacy.close()
+            db.commit()
+        registry.add(root, db_path)
+        return db
+    finally:
+        if own_registry:
+            registry.close()
+
+def _attached_groups(datasets):
+    conn = sqlite3.connect(':memory:')
+    try:
+        datasets = [(root, db_path) for root, db_path in datasets if os.path.isfile(db_path)]
+        for root, db_path in datasets:
+            TagDatabase(db_path, root=root).close()
+        for start in range(0, len(datasets), MAX_ATTACHED):
+            group = datasets[start:start + MAX_ATTACHED]
+            for i, (_, db_path) in enumerate(group):
+                conn.execute(f"ATTACH DATABASE ? AS ds{i}", (db_path,))
+            try:
+                yield conn, group
+            finally:
+                for i in range(len(group)):
+                    conn.execute(f"DETACH DATABASE ds{i}")
+    finally:
+        conn.close()
+
+def query_datasets(datasets, expression):
+    compile_query(expression)
+    for conn, group in _attached_groups(datasets):
+        selects, params = [], []
+        for i in range(len(group)):
+            sql, query_params = compile_query(expression, f"ds{i}")
+            selects.append(f"SELECT {i}, path FROM ds{i}.images WHERE id IN ({sql})")
+            params.extend(query_params)
+        for i, path in conn.execute(" UNION ALL ".join(selects), params):
+            yield os.path.join(group[i][0], path)
+
+def dataset_stats(datasets):
+    images = tagged = count = 0
+    tag_counts = {}
+    for conn, group in _attached_groups(datasets):
+        count += len(group)
+        totals = " UNION ALL ".join(
+            f"SELECT COUNT(*), COALESCE(SUM(tag_count > 0), 0) FROM ds{i}.images" for i in range(len(group))
+        )
+        for group_images, group_tagged in conn.execute(totals):
+            images += group_images
+            tagged += group_tagged
+        counts = " UNION ALL ".join(f'''
+            SELECT tags.name AS name, COUNT(image_tags.image_id) AS n FROM ds{i}.tags AS tags
+            LEFT JOIN ds{i}.image_tags AS image_tags ON image_tags.tag_id = tags.id
+            GROUP BY tags.id
+        ''' for i in range(len(group)))
+        for name, tag_count in conn.execute(f"SELECT name, SUM(n) FROM ({counts}) GROUP BY name"):
+            tag_counts[name] = tag_counts.get(name, 0) + tag_count
+    return {
+        'datasets': count,
+        'images': images,
+        'tagged': tagged,
+        'unlabeled': images - tagged,
+        'tags': dict(sorted(tag_counts.items(), key=lambda item: (-item[1], item[0]))),
+    }